@@ -2,6 +2,7 @@ import os
 import pathlib
 import subprocess
 import time
+import xml.etree.ElementTree as ElementTree
 from datetime import datetime
 from typing import Optional, Literal
 
@@ -75,7 +76,21 @@ class DiscordBot(commands.Bot):
         print_coloured(Colour.Yellow, f"Connecting to the wiki...\n")
 
         self.wiki = WikiInterface(self.configs["secrets"].user_agent, self.configs["constants"].max_mw_query_len,
-                                  self.configs["constants"].wiki_base_url)
+                                  self.configs["constants"].wiki_base_url,
+                                  sync_state_path=pathlib.Path("cache") / "wiki_sync.json",
+                                  cache_path=pathlib.Path("cache") / "wiki_cache.sqlite3",
+                                  title_index_path=pathlib.Path("cache") / "wiki_titles.idx")
+
+        # Bootstrap the local wiki indexes from a dump when one is available, rather than the API
+        dump_path = pathlib.Path("cache") / "wiki_dump.xml"
+        if dump_path.exists():
+            print_coloured(Colour.Yellow, f"Loading the wiki dump...\n")
+            try:
+                await self.wiki.load_dump(dump_path)
+            except (ElementTree.ParseError, OSError, KeyError, ValueError) as e:
+                # A malformed or partly copied dump leaves the indexes empty, so the wiki cog builds them from the API
+                print_coloured(Colour.Yellow, f"Could not load the wiki dump, building the wiki indexes from the "
+                                              f"API instead: {e!r}\n")
 
         general_config: GeneralConfig = self.configs["general"]
 
@@ -98,6 +113,12 @@ class DiscordBot(commands.Bot):
         print_coloured(Colour.Green, f"Cogs loaded \"{general_config.default_settings['prefix']}\"")
         print_coloured(Colour.Green, f"√ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √ √")
 
+    async def close(self):
+        """Close the wiki connection before shutting the bot down."""
+        if self.wiki is not None:
+            await self.wiki.close()
+        await super().close()
+
 async def get_prefix(_bot: DiscordBot, message: discord.Message):
     try:
         return (await _bot.settings.get_one(message.guild.id)).prefix
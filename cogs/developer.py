@@ -104,6 +104,15 @@ class Developer(commands.Cog):
             command = ['git', 'pull', 'origin', 'dev' if branch == 'dev' else 'main']
             await ctx.send(f"```\n{subprocess.check_output(command).decode('utf-8')[:1900]}\n```")
 
+    @commands.command(name="wikicache", hidden=True, aliases=["-wc", "~wc"])
+    @dev_only
+    async def wiki_cache_stats(self, ctx: commands.Context):
+        """Show how the wiki link cache is performing"""
+        stats = {**self.bot.wiki.link_cache.stats(), **self.bot.wiki.single_flight.stats(),
+                 **{f"http_{name}": value for name, value in self.bot.wiki.wiki.response_cache.stats().items()},
+                 **{f"advsearch_{name}": value for name, value in self.bot.wiki.advanced_search_cache.stats().items()}}
+        await ctx.send("```\n" + "\n".join(f"{name}: {value}" for name, value in stats.items()) + "\n```")
+
 
 async def setup(bot: DiscordBot):
     """Add the Developer cog to the bot.
@@ -1,5 +1,8 @@
+import itertools
+import logging
 import re
-from typing import List, Union
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import discord
 from discord.ext import commands, tasks
@@ -7,9 +10,83 @@ from discord import app_commands
 
 from bot import DiscordBot
 from data_management.data_protocols import ConstantsConfig
+from helpers.rate_limiter import WikiUnavailableError
 from helpers.utils import stable_bot_check
+from helpers.wiki_client import PageSummary, WikiError
 from helpers.views import PaginatedSearchView
 
+logger = logging.getLogger(__name__)
+
+# [[x]] = capture group g1, {{x}} = capture group g2
+WIKI_LINK_PATTERN = re.compile(
+    r"\[\[(?!\s+\])((?:[\w\s]+:)?(?:[\w\s]{3,}))\]\]|\{\{(?!\s+\])((?:[\w\s]+:)?(?:[\w\s]{3,}))\}\}")
+# Stop looking for links in a message after this many, as no more than MAX_RESULT_COUNT are ever sent
+MAX_LINK_CANDIDATES = 25
+MIN_QUERY_LENGTH = 3
+MAX_EMBED_COUNT = 3
+MAX_RESULT_COUNT = 10
+# The number of recent replies remembered so they can be updated when the message they reply to is edited
+MAX_TRACKED_REPLIES = 500
+
+
+def parse_queries(content: str) -> List[Tuple[str, bool]]:
+    """Find the queries enclosed in [[]] or {{}} in a message.
+
+    :param content: the content of the message.
+    :returns: (query, embed) tuples without duplicates, in order, where embed = True means the link should have an
+        embed."""
+    if "[[" not in content and "{{" not in content:
+        return []
+    res = [match.groups() for match in itertools.islice(WIKI_LINK_PATTERN.finditer(content), MAX_LINK_CANDIDATES)]
+
+    response_data = []
+    for g1, g2 in res:
+        text = g1 or g2
+        processed_text = re.sub(r"\s+", " ", text.strip())
+        if (len(processed_text) >= MIN_QUERY_LENGTH and
+                (":" not in processed_text or len(processed_text.split(":")[1]) >= MIN_QUERY_LENGTH)):
+            response_data.append((processed_text, False if g1 else True))
+
+    # Remove duplicate queries
+    return list(dict.fromkeys(response_data))
+
+
+def format_msg(data: List[Tuple[str, bool]], resolved: Dict[str, Optional[str]]) -> List[Tuple[str, bool]]:
+    """Choose the results to reply with, and which of them to embed.
+
+    :param data: (query, embed) tuples for each query in the message, in order.
+    :param resolved: a dict mapping each query to its link, or None if nothing is found.
+    :returns: (link, embed) tuples for each link to reply with, in order."""
+    embedded_pages = []
+    results = 0
+    seen_queries = set()
+
+    lines = []
+    for (query, embed) in data:
+        # Limit to 10 results
+        if results >= MAX_RESULT_COUNT:
+            return lines
+
+        # Get result of query
+        result = resolved[query]
+
+        if result is None or result in seen_queries:
+            continue
+        results += 1
+        seen_queries.add(result)
+
+        # Prevent more than 5 pages being embedded
+        if (embed and not ((result in embedded_pages) or
+                ("#" in result and result.split("#")[0] in embedded_pages))):
+            if len(embedded_pages) < MAX_EMBED_COUNT:
+                embedded_pages.append(result.split("#")[0] if "#" in result else result)
+            else:
+                embed = False
+
+        lines.append((result, embed))
+    return lines
+
+
 class Wiki(commands.Cog):
     """Wiki commands and listeners."""
 
@@ -19,20 +96,52 @@ class Wiki(commands.Cog):
         :param bot: The DiscordBot instance.
         """
         self.bot = bot
-        self.on_message_cache = {}
         constants: ConstantsConfig = self.bot.configs["constants"]
         self.max_mw_query_len = constants.max_mw_query_len
         self.wiki_base_url = constants.wiki_base_url
+        # Map the ID of each recent message replied to with links to the reply and the links it was built from
+        self._replies: OrderedDict[int, Tuple[discord.Message, Dict[str, Optional[str]]]] = OrderedDict()
         super().__init__()
-        self.clear_on_message_cache.start()
+        self.sync_wiki.start()
+        self.flush_wiki_cache.start()
+        self.warm_wiki_cache.start()
 
     def cog_unload(self) -> None:
-        self.clear_on_message_cache.cancel()
+        self.sync_wiki.cancel()
+        self.flush_wiki_cache.cancel()
+        self.warm_wiki_cache.cancel()
+
+    @tasks.loop(count=1)
+    async def warm_wiki_cache(self):
+        """Resolve the most linked queries at startup, so they are answered from the cache from the first message"""
+        try:
+            await self.bot.wiki.warm_link_cache()
+        except (WikiUnavailableError, TimeoutError):
+            pass
+        except Exception:
+            logger.exception("Failed to warm the wiki link cache")
 
-    @tasks.loop(hours=24)
-    async def clear_on_message_cache(self):
-        """Clear the on_message cache to allow new results to be fetched"""
-        self.on_message_cache.clear()
+    @tasks.loop(seconds=30)
+    async def flush_wiki_cache(self):
+        """Write newly cached wiki results to disk so they survive restarts"""
+        try:
+            await self.bot.wiki.flush_cache()
+        except Exception:
+            logger.exception("Failed to write the wiki cache to disk")
+
+    @tasks.loop(minutes=1)
+    async def sync_wiki(self):
+        """Keep the local wiki indexes and link cache in step with changes made on the wiki"""
+        try:
+            if not self.bot.wiki.indexes_ready:
+                await self.bot.wiki.refresh_indexes()
+            await self.bot.wiki.sync_recent_changes()
+        except (WikiUnavailableError, TimeoutError):
+            # The wiki is unavailable, so wait for it to recover
+            pass
+        except Exception:
+            # Keep the current state and try again next time rather than stopping the loop
+            logger.exception("Failed to sync with the wiki")
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -41,92 +150,173 @@ class Wiki(commands.Cog):
         [[]] will not embed, {{}} will.
 
         :param message: the message that was sent"""
-        # Check if this message should be processed
+        # Check if this message should be processed, cheapest checks first as most messages contain no links
         if message.author.bot:
             return
-        ctx = await self.bot.get_context(message)
-        if not stable_bot_check(ctx):
+        response_data = parse_queries(message.content)
+        if len(response_data) == 0 or not await self.can_reply(message):
             return
-        check = await self.bot.settings.get_permissions_check(ctx, event_type="on_message_wiki_links")
-        if check is not None and not check.evaluate(ctx):
+
+        resolved = await self.resolve_queries(message, [query for query, _ in response_data])
+        msg, embeds = await self.build_reply(response_data, resolved)
+        if msg == "":
             return
+        reply = await message.channel.send(msg, embeds=embeds, mention_author=False,
+                                           allowed_mentions=discord.AllowedMentions.none())
+        self.track_reply(message, reply, resolved)
 
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        """Update the links sent for a message when it is edited, such as to fix a typo in a link.
 
-        msg = message.content
+        Only queries that were added by the edit are resolved, and the earlier reply is edited in place.
 
-        # [[x]] = capture group g1, {{x}} = capture group g2
-        res = re.findall(
-            r"\[\[(?!\s+\])((?:[\w\s]+:)?(?:[\w\s]{3,}))\]\]|\{\{(?!\s+\])((?:[\w\s]+:)?(?:[\w\s]{3,}))\}\}", msg)
+        :param before: the message before it was edited
+        :param after: the message after it was edited"""
+        if after.author.bot or before.content == after.content:
+            return
+        tracked = self._replies.get(after.id)
+        response_data = parse_queries(after.content)
+        if tracked is None and len(response_data) == 0:
+            return
+        # Edits that do not change the links, such as fixing a typo elsewhere in the message, need no reply
+        if response_data == parse_queries(before.content):
+            return
+        if not await self.can_reply(after):
+            return
 
-        # response_data is [(text, embed)] list, embed = True means link should have embed
-        MIN_QUERY_LENGTH = 3
-        MAX_EMBED_COUNT = 3
-        MAX_RESULT_COUNT = 10
+        reply, previous = tracked if tracked is not None else (None, {})
+        queries = [query for query, _ in response_data]
+        resolved = {query: previous[query] for query in queries if query in previous}
+        resolved.update(await self.resolve_queries(after, [query for query in queries if query not in previous]))
+        msg, embeds = await self.build_reply(response_data, resolved)
 
-        response_data = []  
-        for g1, g2 in res:
-            text = g1 or g2 
-            processed_text = re.sub(r"\s+", " ", text.strip())
-            if (len(processed_text) >= MIN_QUERY_LENGTH and
-                    (":" not in processed_text or len(processed_text.split(":")[1]) >= MIN_QUERY_LENGTH)):
-                response_data.append((processed_text, False if g1 else True))
-        
-        if len(response_data) == 0:
+        if reply is None:
+            if msg != "":
+                reply = await after.channel.send(msg, embeds=embeds, mention_author=False,
+                                                 allowed_mentions=discord.AllowedMentions.none())
+                self.track_reply(after, reply, resolved)
             return
-        
-        # Remove duplicate queries
-        response_data = list(dict.fromkeys(response_data))
-
-        # Local function to format the results message
-        def format_msg(data: List[Union[str, bool]]):
-            embedded_pages = []
-            results = 0
-            seen_queries = set()
-
-            message = ""
-            for (query, embed) in data:
-                # Limit to 10 results
-                if results >= MAX_RESULT_COUNT:
-                    return message
-
-                # Get result of query
-                if query.lower() in self.on_message_cache:
-                    result = self.on_message_cache[query.lower()]
-                else:
-                    result = self.bot.wiki.page_or_section_search(query)
-                    if result is None and ":" in query and query.split(":")[0].lower() == "new":
-                        result = f"{self.wiki_base_url}{query.split(':')[1]}?action=edit&redlink=1"
-                    else:
-                        self.on_message_cache[query.lower()] = result
-
-                if result is None or result in seen_queries:
-                    continue
-                results += 1
-                seen_queries.add(result)
-
-                # Prevent more than 5 pages being embedded
-                if (embed and not ((result in embedded_pages) or
-                        ("#" in result and result.split("#")[0] in embedded_pages))):
-                    if len(embedded_pages) < MAX_EMBED_COUNT:
-                        embedded_pages.append(result.split("#")[0] if "#" in result else result)
-                    else:
-                        embed = False
-
-                # Format message
-                message += f"<{result}>\n" if not embed else f"{result}\n"
-            return message
+        try:
+            if msg == "":
+                # None of the links in the message find anything any more
+                await reply.delete()
+                self._replies.pop(after.id, None)
+            else:
+                await reply.edit(content=msg, embeds=embeds, allowed_mentions=discord.AllowedMentions.none())
+                self.track_reply(after, reply, resolved)
+        except discord.NotFound:
+            # The reply has been deleted, so stop updating it
+            self._replies.pop(after.id, None)
+
+    def track_reply(self, message: discord.Message, reply: discord.Message,
+                    resolved: Dict[str, Optional[str]]) -> None:
+        """Remember the reply sent for a message and the links it was built from, so it can be updated on edit.
+
+        Only the most recent replies are remembered, as messages are rarely edited long after they are sent.
+
+        :param message: the message that was replied to.
+        :param reply: the reply.
+        :param resolved: a dict mapping each query in the message to its link."""
+        self._replies[message.id] = (reply, resolved)
+        self._replies.move_to_end(message.id)
+        while len(self._replies) > MAX_TRACKED_REPLIES:
+            self._replies.popitem(last=False)
+
+    async def can_reply(self, message: discord.Message) -> bool:
+        """Check whether links may be sent in reply to a message.
+
+        :param message: the message to reply to.
+        :returns: whether the message may be replied to."""
+        # Building the context may need a database lookup for the prefix, so only do this for messages with links
+        ctx = await self.bot.get_context(message)
+        if not stable_bot_check(ctx):
+            return False
+        check = await self.bot.settings.get_permissions_check(ctx, event_type="on_message_wiki_links")
+        return check is None or check.evaluate(ctx)
+
+    async def resolve_queries(self, message: discord.Message, queries: List[str]) -> Dict[str, Optional[str]]:
+        """Find the link for each query, from the cache where possible.
+
+        :param message: the message the queries are from, which shows the bot typing while the wiki is asked.
+        :param queries: the pages or sections to find.
+        :returns: a dict mapping each query to its link, or None if nothing is found."""
+        # Get cached results, replying with stale ones straight away and refreshing them in the background
+        resolved = {}
+        uncached = []
+        stale = []
+        for query in queries:
+            entry = await self.bot.wiki.cached_link(query, allow_stale=True)
+            if entry is None:
+                uncached.append(query)
+            else:
+                resolved[query] = entry.value
+                if entry.stale:
+                    stale.append(query)
+        self.bot.wiki.revalidate_links(stale)
 
         # At least one query isn't cached
-        if any([query.lower() not in self.on_message_cache for (query, _) in response_data]):
-            async with (message.channel.typing()):
-                msg = format_msg(response_data)
+        if len(uncached) > 0 and self.bot.wiki.available:
+            try:
+                async with (message.channel.typing()):
+                    resolved.update(await self.bot.wiki.resolve_links(list(dict.fromkeys(uncached)),
+                                                                       limit=MAX_RESULT_COUNT))
+            except (WikiUnavailableError, TimeoutError):
+                pass
+
+        # Queries the wiki was not asked about, because it is unavailable or enough links were already found, are only
+        # answered from what is known locally
+        for query in uncached:
+            if query not in resolved:
+                resolved[query] = self.bot.wiki.indexed_link(query)
+        return resolved
+
+    async def build_reply(self, response_data: List[Tuple[str, bool]],
+                          resolved: Dict[str, Optional[str]]) -> Tuple[str, List[discord.Embed]]:
+        """Build the reply listing the links found for a message.
 
-        # All queries are cached
-        else:
-            msg = format_msg(response_data)
+        :param response_data: (query, embed) tuples for each query in the message, in order.
+        :param resolved: a dict mapping each query to its link, or None if nothing is found.
+        :returns: the text of the reply, which is empty if nothing was found, and the embeds to send with it."""
+        lines = format_msg(response_data, resolved)
+        if len(lines) == 0:
+            return "", []
 
-        if msg != "":
-            await message.channel.send(msg, mention_author=False, allowed_mentions=discord.AllowedMentions.none())
+        # Embed previews built from the wiki's summaries, leaving any pages without one to Discord's link preview
+        summaries = await self.page_summaries([result for result, embed in lines if embed])
+        msg = "".join(f"{result}\n" if embed and result not in summaries else f"<{result}>\n"
+                      for result, embed in lines)
+        embeds = {}
+        for result, embed in lines:
+            # Sections of the same page share one embed
+            if embed and result in summaries and summaries[result].title not in embeds:
+                embeds[summaries[result].title] = self.summary_embed(result, summaries[result])
+        return msg, list(embeds.values())[:MAX_EMBED_COUNT]
+
+    async def page_summaries(self, links: List[str]) -> Dict[str, PageSummary]:
+        """Get the summaries to embed for links, without waiting for the wiki if it is unavailable.
+
+        :param links: the links to embed.
+        :returns: a dict mapping each link to the summary of its page, leaving out links without one."""
+        if len(links) == 0 or not self.bot.wiki.available:
+            return {}
+        try:
+            return await self.bot.wiki.page_summaries(links)
+        except (WikiUnavailableError, TimeoutError, WikiError):
+            # Reply with plain links rather than not at all
+            return {}
+
+    @staticmethod
+    def summary_embed(link: str, summary: PageSummary) -> discord.Embed:
+        """Build an embed previewing a page.
+
+        :param link: the link to the page or section.
+        :param summary: the summary of the page.
+        :returns: the embed."""
+        embed = discord.Embed(title=summary.title, url=link, description=summary.extract, colour=0x006798)
+        if summary.thumbnail is not None:
+            embed.set_thumbnail(url=summary.thumbnail)
+        return embed
 
     @commands.hybrid_command(name="search")
     @app_commands.describe(query="The query to search for")
@@ -137,10 +327,10 @@ class Wiki(commands.Cog):
         if len(query) > self.max_mw_query_len:
             raise commands.UserInputError(f"Search queries cannot be over {self.max_mw_query_len} characters.")
         async with ctx.typing():
-            results = self.bot.wiki.search(query)
+            results = await self.bot.wiki.search(query)
         if len(results) == 0:
-            await ctx.reply(f"No results found for: {query}", mention_author=False, ephemeral=True,
-                            allowed_mentions=discord.AllowedMentions.none())
+            await ctx.reply(f"No results found for: {query}{self.suggestions(query)}", mention_author=False,
+                            ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
             return
         constants: ConstantsConfig = self.bot.configs["constants"]
         links = {result: f"{constants.wiki_base_url}wiki/{result.replace(' ', '_')}" for result in results}
@@ -166,10 +356,10 @@ class Wiki(commands.Cog):
 
         if len(query) > self.max_mw_query_len:
             raise commands.UserInputError(f"Search queries cannot be over {self.max_mw_query_len} characters.")
-        results = self.bot.wiki.advanced_search(query)
+        results = await self.bot.wiki.advanced_search(query)
         if len(results) == 0:
-            await ctx.reply(f"No results found for: {query}", mention_author=False, ephemeral=True,
-                            allowed_mentions=discord.AllowedMentions.none())
+            await ctx.reply(f"No results found for: {query}{self.suggestions(query)}", mention_author=False,
+                            ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
             return
         view = PaginatedSearchView(results, author=ctx.author)
         view.message = await ctx.reply(view.pages[0], view=view, mention_author=False, ephemeral=True,
@@ -177,8 +367,39 @@ class Wiki(commands.Cog):
         await view.wait()
         if view.result is None:
             return
-        result = self.bot.wiki.page_search(view.result)
-        await ctx.reply(result.url, ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
+        link = await self.bot.wiki.search_result_link(view.result)
+        if link is None:
+            await ctx.reply(f"{view.result} no longer exists.", mention_author=False, ephemeral=True,
+                            allowed_mentions=discord.AllowedMentions.none())
+            return
+        related = self.bot.wiki.related_pages(view.result)
+        if len(related) > 0:
+            link += f"\n-# Related pages: {self.format_titles(related)}"
+        await ctx.reply(link, ephemeral=True, allowed_mentions=discord.AllowedMentions.none())
+
+    def suggestions(self, query: str) -> str:
+        """Suggest pages similar to a query that found nothing, from the local index.
+
+        :param query: the query that found nothing.
+        :returns: a line suggesting pages to append to the reply, or an empty string if there are none."""
+        suggestions = self.bot.wiki.suggest_pages(query)
+        return f"\n-# Did you mean: {self.format_titles(suggestions)}" if len(suggestions) > 0 else ""
+
+    def format_titles(self, titles: List[str]) -> str:
+        """Format page titles as a list of links without previews.
+
+        :param titles: the titles of the pages.
+        :returns: the formatted links."""
+        return ", ".join(f"[{title}](<{self.bot.wiki.title_url(title)}>)" for title in titles)
+
+    @search.autocomplete("query")
+    @advanced_search.autocomplete("query")
+    async def query_autocomplete(self, interaction: discord.Interaction,
+                                 current: str) -> List[app_commands.Choice[str]]:
+        """Suggest page titles and sections as the query is typed"""
+        # Discord limits choice names and values to 100 characters
+        return [app_commands.Choice(name=suggestion[:100], value=suggestion[:100])
+                for suggestion in self.bot.wiki.autocomplete(current)]
 
 
 async def setup(bot: DiscordBot):
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import pathlib
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class WikiCacheStore:
+    """A SQLite file holding the results of wiki lookups, so restarts start with a warm cache.
+
+    Reads are made lazily, the first time a query misses the in-memory cache. Writes are queued and written
+    behind in batches by `flush`, so storing a result never waits on the disk.
+    """
+    # Hit counts halve over this many seconds, so the top queries follow recent demand rather than all-time counts
+    HIT_HALF_LIFE = 7 * 24 * 60 * 60
+    # Hit counts are decayed at most this often, in seconds
+    HIT_DECAY_INTERVAL = 60 * 60
+    # Queries whose decayed hit count falls below this are forgotten, which takes two half-lives for a single hit
+    MIN_HITS = 0.25
+    # The most queries whose hits are counted, keeping those with the most hits
+    MAX_TRACKED_QUERIES = 10000
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock()
+        # Map each key to the (value, title, stored_at) waiting to be written
+        self._pending_links: Dict[str, Tuple[Optional[str], Optional[str], float]] = {}
+        self._pending_searches: Dict[str, Tuple[str, float]] = {}
+        # Map each key to the latest query for it and the number of hits not yet written
+        self._pending_hits: Dict[str, Tuple[str, int]] = {}
+        self._hits_decayed_at = time.monotonic()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the database, creating it if needed."""
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS links (
+                    key TEXT PRIMARY KEY,
+                    link TEXT,
+                    title TEXT,
+                    stored_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS links_title ON links (title);
+                CREATE TABLE IF NOT EXISTS searches (
+                    key TEXT PRIMARY KEY,
+                    results TEXT NOT NULL,
+                    stored_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS query_hits (
+                    key TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    hits REAL NOT NULL
+                );
+            """)
+        return self._connection
+
+    async def _run(self, function, *args):
+        """Run a database operation in a worker thread, one at a time."""
+        async with self._lock:
+            return await asyncio.to_thread(function, *args)
+
+    def _fetch_one(self, sql: str, params: tuple) -> Optional[tuple]:
+        return self._connect().execute(sql, params).fetchone()
+
+    async def get_link(self, key: str) -> Optional[Tuple[Optional[str], float]]:
+        """Get a stored link.
+
+        :param key: the normalised query.
+        :returns: a (link, stored_at) tuple, where link is None for a stored miss, or None if nothing is stored."""
+        if key in self._pending_links:
+            link, _, stored_at = self._pending_links[key]
+            return link, stored_at
+        return await self._run(self._fetch_one, "SELECT link, stored_at FROM links WHERE key = ?", (key,))
+
+    def put_link(self, key: str, link: Optional[str], title: Optional[str]) -> None:
+        """Queue a link to be stored.
+
+        :param key: the normalised query.
+        :param link: the link that was found, or None if nothing was found.
+        :param title: the normalised title of the page the link points to, used to invalidate it later."""
+        self._pending_links[key] = (link, title, time.time())
+
+    async def get_search(self, key: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Get stored search results.
+
+        :param key: the search query.
+        :returns: a (results, stored_at) tuple, or None if nothing is stored."""
+        if key in self._pending_searches:
+            results, stored_at = self._pending_searches[key]
+        else:
+            row = await self._run(self._fetch_one, "SELECT results, stored_at FROM searches WHERE key = ?", (key,))
+            if row is None:
+                return None
+            results, stored_at = row
+        return json.loads(results), stored_at
+
+    def put_search(self, key: str, results: Dict[str, Any]) -> None:
+        """Queue search results to be stored.
+
+        :param key: the search query.
+        :param results: the search results, as a JSON-serialisable dict."""
+        self._pending_searches[key] = (json.dumps(results), time.time())
+
+    def record_hit(self, key: str, query: str) -> None:
+        """Queue a lookup of a query to be counted.
+
+        :param key: the normalised query.
+        :param query: the query as it was written."""
+        _, hits = self._pending_hits.get(key, (query, 0))
+        self._pending_hits[key] = (query, hits + 1)
+
+    def _top_queries(self, limit: int) -> List[str]:
+        return [row[0] for row in self._connect().execute(
+            "SELECT query FROM query_hits ORDER BY hits DESC LIMIT ?", (limit,))]
+
+    async def top_queries(self, limit: int) -> List[str]:
+        """Get the queries that have been looked up the most, with recent lookups counting for more.
+
+        :param limit: the number of queries to get.
+        :returns: the queries, most looked up first."""
+        return await self._run(self._top_queries, limit)
+
+    def _write(self, links: Dict[str, tuple], searches: Dict[str, tuple], hits: Dict[str, tuple],
+               decay: Optional[float]) -> None:
+        connection = self._connect()
+        with connection:
+            if decay is not None:
+                connection.execute("UPDATE query_hits SET hits = hits * ?", (decay,))
+                connection.execute("DELETE FROM query_hits WHERE hits < ?", (self.MIN_HITS,))
+            connection.executemany("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+                                   [(key, *entry) for key, entry in links.items()])
+            connection.executemany("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                                   [(key, *entry) for key, entry in searches.items()])
+            connection.executemany("INSERT INTO query_hits VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                                   "query = excluded.query, hits = hits + excluded.hits",
+                                   [(key, *entry) for key, entry in hits.items()])
+            if decay is not None:
+                connection.execute("DELETE FROM query_hits WHERE key NOT IN "
+                                   "(SELECT key FROM query_hits ORDER BY hits DESC LIMIT ?)",
+                                   (self.MAX_TRACKED_QUERIES,))
+
+    async def flush(self) -> None:
+        """Write every queued result and hit count to disk, decaying and pruning the stored hit counts."""
+        if len(self._pending_links) == 0 and len(self._pending_searches) == 0 and len(self._pending_hits) == 0:
+            return
+        links, self._pending_links = self._pending_links, {}
+        searches, self._pending_searches = self._pending_searches, {}
+        hits, self._pending_hits = self._pending_hits, {}
+        # Decay by the time since the last decay, so hit counts halve every half-life however often this runs
+        elapsed = time.monotonic() - self._hits_decayed_at
+        decay = None
+        if elapsed >= self.HIT_DECAY_INTERVAL:
+            decay = 0.5 ** (elapsed / self.HIT_HALF_LIFE)
+            self._hits_decayed_at += elapsed
+        await self._run(self._write, links, searches, hits, decay)
+
+    def _delete(self, titles: List[str]) -> None:
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM links WHERE link IS NULL")
+            connection.executemany("DELETE FROM links WHERE key = ? OR title = ?", [(title, title) for title in titles])
+            connection.execute("DELETE FROM searches")
+
+    async def invalidate(self, titles: Iterable[str]) -> None:
+        """Remove stored results that may have been affected by changes to the given pages.
+
+        Misses and search results are always removed, as any change may affect them.
+
+        :param titles: the normalised titles of the pages that changed."""
+        titles = set(titles)
+        self._pending_links = {key: entry for key, entry in self._pending_links.items()
+                               if entry[0] is not None and key not in titles and entry[1] not in titles}
+        self._pending_searches = {}
+        await self._run(self._delete, list(titles))
+
+    async def close(self) -> None:
+        """Write every queued result and close the database."""
+        await self.flush()
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
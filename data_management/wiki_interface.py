@@ -1,24 +1,493 @@
-from typing import List
+import asyncio
+import json
+import logging
+import pathlib
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-import mediawiki
-from mediawiki import MediaWikiPage
+from data_management.wiki_cache_store import WikiCacheStore
+from helpers.caches import CacheEntry, ExpiringCache, LinkCache, SingleFlight
+from helpers.rate_limiter import WikiUnavailableError
+from helpers.related_pages import RelatedPages
+from helpers.search_engine import BM25Index, wikitext_to_plaintext
+from helpers.wiki_dump import iter_dump_pages
+from helpers.wiki_client import AsyncMediaWiki, PageError, PageSummary, WikiPage
+from helpers.wiki_index import PrefixIndex, SectionIndex, TitleIndex, normalise_title, parse_headings
+from helpers.wiki_index_file import MappedTitleIndex, write_title_index
+from helpers.wiki_lib_patch import SearchResult, SearchResultPager
 
-from helpers.wiki_lib_patch import PatchedMediaWiki, SearchResult
+logger = logging.getLogger(__name__)
+
+# Revo wiki Guide namespace ID = 3000
+WIKI_NAMESPACES = [0, 3000]
+# The most fallback searches made at once when resolving several links together
+MAX_CONCURRENT_SEARCHES = 5
+# How close a title with a typo must be to the query, from 0 to 1, to be linked without searching the wiki
+MIN_FUZZY_CONFIDENCE = 0.8
+# Advanced search results are fetched two pages of the results view at a time
+ADVANCED_SEARCH_CHUNK_SIZE = 10
 
 
 class WikiInterface:
-    def __init__(self, user_agent, max_query_len, wiki_base_url):
+    def __init__(self, user_agent, max_query_len, wiki_base_url, sync_state_path: Optional[pathlib.Path] = None,
+                 cache_path: Optional[pathlib.Path] = None, title_index_path: Optional[pathlib.Path] = None):
         self.max_query_len = max_query_len
-        self.wiki = PatchedMediaWiki(url=f"{wiki_base_url}api.php", user_agent=user_agent)
+        self.wiki_base_url = wiki_base_url
+        self.wiki = AsyncMediaWiki(f"{wiki_base_url}api.php", user_agent)
+        self.titles = TitleIndex()
+        # The title index saved by the last run, which answers lookups until the title index is rebuilt
+        self._title_index_path = title_index_path
+        self.saved_titles: Optional[MappedTitleIndex] = self._open_saved_titles()
+        self.sections = SectionIndex()
+        self.text_index = BM25Index()
+        # Searches of the full-text index run in a worker thread, so changes to it wait for them to finish
+        self._text_index_lock = asyncio.Lock()
+        self.related = RelatedPages()
+        self.prefixes = PrefixIndex()
+        self.link_cache = LinkCache()
+        # Concurrent identical lookups share one request to the wiki
+        self.single_flight = SingleFlight()
+        # An optional disk tier behind the in-memory caches, which survives restarts
+        self.store: Optional[WikiCacheStore] = WikiCacheStore(cache_path) if cache_path is not None else None
+        # Stale links being refreshed in the background, and the tasks refreshing them
+        self._revalidating: Set[str] = set()
+        self._revalidation_tasks: Set[asyncio.Task] = set()
+        # Map each (query, limit) to the total hits and first chunk of results from the wiki, as compact tuples
+        self.advanced_search_cache = ExpiringCache(max_entries=256, ttl=30 * 60)
+        # Map each normalised title to the summary embedded for it
+        self.summary_cache = ExpiringCache(max_entries=1000, ttl=6 * 60 * 60)
+        # The position in the recentchanges feed that local state is up-to-date with
+        self._sync_state_path = sync_state_path
+        self._sync_cursor: Optional[dict] = self._load_sync_cursor()
+
+    async def close(self) -> None:
+        """Close the connection to the wiki and save any cached results."""
+        for task in self._revalidation_tasks:
+            task.cancel()
+        if self.saved_titles is not None:
+            self.saved_titles.close()
+            self.saved_titles = None
+        await self.wiki.close()
+        if self.store is not None:
+            await self.store.close()
+
+    async def flush_cache(self) -> None:
+        """Write newly cached results to the disk tier, if there is one."""
+        if self.store is not None:
+            await self.store.flush()
+
+    async def cached_link(self, query: str, allow_stale: bool = False) -> Optional[CacheEntry]:
+        """Get the cached link for a query, checking memory and then the disk tier.
+
+        :param query: the page or section that was searched for.
+        :param allow_stale: whether to return a link that is no longer fresh, which should be passed to
+            `revalidate_links`.
+        :returns: the cache entry, whose value is None for a cached miss, or None if the query is not cached."""
+        if self.store is not None:
+            self.store.record_hit(LinkCache.normalise_key(query), query)
+        entry = self.link_cache.get(query, allow_stale=allow_stale)
+        if entry is not None or self.store is None:
+            return entry
+        stored = await self.store.get_link(LinkCache.normalise_key(query))
+        if stored is None:
+            return None
+        link, stored_at = stored
+        # Results too old to be used even as stale are ignored by the in-memory cache
+        entry = self.link_cache.set(query, link, age=time.time() - stored_at)
+        if entry is None or (entry.stale and not allow_stale):
+            return None
+        return entry
+
+    def cache_link(self, query: str, link: Optional[str]) -> None:
+        """Cache the link found for a query in memory and, eventually, on disk.
+
+        :param query: the page or section that was searched for.
+        :param link: the link that was found, or None if nothing was found."""
+        self.link_cache.set(query, link)
+        if self.store is not None:
+            self.store.put_link(LinkCache.normalise_key(query), link, self.link_title(link) if link else None)
+
+    async def resolve_links(self, queries: List[str], limit: Optional[int] = None) -> Dict[str, Optional[str]]:
+        """Find and cache the links for queries that are not cached, in as few wiki requests as possible.
+
+        Queries of the form `new:Title` that match nothing link to the page editor, so the page can be created.
+
+        :param queries: the pages or sections to search for.
+        :param limit: stop searching for fallback results once this many links have been found.
+        :returns: a dict mapping each query to its link, or None if nothing is found, leaving out queries that were
+            not searched for because the limit was reached."""
+        results = {}
+        for query, result in (await self.batch_page_or_section_search(queries, limit=limit)).items():
+            if result is None and ":" in query and query.split(":")[0].lower() == "new":
+                result = f"{self.wiki_base_url}{query.split(':')[1]}?action=edit&redlink=1"
+            self.cache_link(query, result)
+            results[query] = result
+        return results
+
+    def revalidate_links(self, queries: List[str]) -> None:
+        """Refresh stale cached links in the background, so later lookups get the current link.
+
+        :param queries: the queries whose cached links are stale."""
+        queries = [query for query in dict.fromkeys(queries)
+                   if LinkCache.normalise_key(query) not in self._revalidating]
+        if len(queries) == 0 or not self.available:
+            return
+        keys = {LinkCache.normalise_key(query) for query in queries}
+        self._revalidating.update(keys)
+
+        async def revalidate():
+            try:
+                await self.resolve_links(queries)
+            except (WikiUnavailableError, TimeoutError):
+                # The stale links are kept, and refreshed once the wiki recovers
+                pass
+            except Exception:
+                logger.exception("Failed to refresh stale wiki links")
+            finally:
+                self._revalidating.difference_update(keys)
+
+        task = asyncio.create_task(revalidate())
+        # Keep a reference to the task so it is not garbage collected before it finishes
+        self._revalidation_tasks.add(task)
+        task.add_done_callback(self._revalidation_tasks.discard)
+
+    async def warm_link_cache(self, limit: int = 100) -> int:
+        """Resolve the most looked up queries again, so they are cached and fresh before anyone asks for them.
+
+        :param limit: the number of queries to resolve.
+        :returns: the number of queries resolved."""
+        if self.store is None:
+            return 0
+        queries = await self.store.top_queries(limit)
+        if len(queries) > 0:
+            await self.resolve_links(queries)
+        return len(queries)
+
+    @property
+    def available(self) -> bool:
+        """Whether requests are being made to the wiki, rather than refused because it has been failing."""
+        return not self.wiki.limiter.breaker.is_open
+
+    def title_url(self, title: str, fragment: Optional[str] = None) -> str:
+        """Build the URL of a page without asking the wiki.
+
+        :param title: the canonical title of the page.
+        :param fragment: the section of the page to link to, if any.
+        :returns: the URL of the page or section."""
+        # These are the characters MediaWiki leaves unescaped in its own URLs
+        url = f"{self.wiki_base_url}wiki/{urllib.parse.quote(title.replace(' ', '_'), safe=';@$!*(),/~:')}"
+        return f"{url}#{fragment.replace(' ', '_')}" if fragment else url
+
+    async def refresh_title_index(self) -> None:
+        """Rebuild the title index from the wiki's page and redirect lists."""
+        titles = []
+        redirect_titles = {}
+        for namespace in WIKI_NAMESPACES:
+            async for page in self.wiki.all_pages(namespace):
+                titles.append(page["title"])
+            async for page in self.wiki.all_pages(namespace, redirects=True):
+                redirect_titles[page["pageid"]] = page["title"]
+        redirects = []
+        for namespace in WIKI_NAMESPACES:
+            async for redirect_id, target, fragment in self.wiki.all_redirects(namespace):
+                # Redirects from namespaces that are not indexed are skipped
+                if redirect_id in redirect_titles:
+                    redirects.append((redirect_titles[redirect_id], target, fragment))
+        self.titles.rebuild(titles, redirects)
+
+    async def refresh_page_index(self) -> None:
+        """Rebuild the section and full-text indexes from the wikitext of every page."""
+        pages = []
+        for namespace in WIKI_NAMESPACES:
+            async for page in self.wiki.page_texts(namespace):
+                pages.append((page["pageid"], page["ns"], page["title"], page["text"]))
+        # Parsing and indexing every page takes seconds, so it is kept off the event loop
+        async with self._text_index_lock:
+            await asyncio.to_thread(self._rebuild_page_index, pages)
+
+    def _rebuild_page_index(self, pages: List[Tuple[int, int, str, str]]) -> None:
+        """Rebuild the section, full-text and related page indexes.
+
+        :param pages: (pageid, ns, title, wikitext) tuples for every page."""
+        self.sections.rebuild((title, parse_headings(text)) for _, _, title, text in pages)
+        self.text_index.rebuild([(pageid, ns, title, wikitext_to_plaintext(text)) for pageid, ns, title, text in pages])
+        self.related.rebuild(self.text_index.term_counts())
+
+    async def refresh_pages(self, titles: List[str]) -> None:
+        """Update the section and full-text indexes for specific pages, such as those which were recently edited.
+
+        :param titles: the titles of the pages to update."""
+        changes = {}
+        async for page in self.wiki.page_texts(titles=titles):
+            async with self._text_index_lock:
+                if page.get("missing") or page["redirect"] or page["ns"] not in WIKI_NAMESPACES:
+                    self.sections.remove(page["title"])
+                    self.text_index.remove(page["title"])
+                    changes[page["title"]] = None
+                else:
+                    self.sections.update(page["title"], parse_headings(page["text"]))
+                    self.text_index.update(page["pageid"], page["ns"], page["title"],
+                                           wikitext_to_plaintext(page["text"]))
+                    changes.update(self.text_index.term_counts([page["title"]]))
+        if self.related.ready and len(changes) > 0:
+            self.related.update(changes)
+            # Rebuild from scratch once enough pages have changed for the term weights to have drifted
+            if self.related.changes_since_rebuild > len(self.related) // 10:
+                await asyncio.to_thread(self.related.rebuild, self.text_index.term_counts())
+
+    def refresh_prefix_index(self) -> None:
+        """Rebuild the autocomplete index from the title and section indexes."""
+        self.prefixes.rebuild(self.titles.titles, self.sections.entries())
+
+    def related_pages(self, title: str, limit: int = 3) -> List[str]:
+        """Find the pages most related to a page, from the precomputed table.
+
+        :param title: the title of the page.
+        :param limit: the maximum number of pages to return.
+        :returns: the titles of the related pages, most related first."""
+        return [related for related, _ in self.related.related(title)[:limit]]
+
+    def suggest_pages(self, text: str, limit: int = 3) -> List[str]:
+        """Suggest pages with similar text to a query, without asking the wiki.
+
+        :param text: the query, such as one that found no results.
+        :param limit: the maximum number of pages to suggest.
+        :returns: the titles of the suggested pages, most similar first."""
+        return self.related.suggest(text[:self.max_query_len], limit)
+
+    def autocomplete(self, text: str, limit: int = 25) -> List[str]:
+        """Suggest pages and sections starting with some text, without asking the wiki.
+
+        :param text: the text typed so far.
+        :param limit: the maximum number of suggestions.
+        :returns: the matching titles and `Page#Section` anchors."""
+        return self.prefixes.complete(text[:self.max_query_len], limit)
+
+    def _open_saved_titles(self) -> Optional[MappedTitleIndex]:
+        """Open the title index saved by a previous run, if there is a usable one."""
+        if self._title_index_path is None:
+            return None
+        try:
+            return MappedTitleIndex(self._title_index_path)
+        except (OSError, ValueError):
+            return None
+
+    async def save_title_index(self) -> None:
+        """Save the title index to disk, so the next run can answer lookups before it has rebuilt the index."""
+        if self._title_index_path is None or not self.titles.ready:
+            return
+        entries = list(self.titles.entries())
+        await asyncio.to_thread(write_title_index, self._title_index_path, entries)
+        # The title index answers lookups from now on
+        if self.saved_titles is not None:
+            self.saved_titles.close()
+            self.saved_titles = None
+
+    @property
+    def titles_available(self) -> bool:
+        """Whether titles can be looked up without asking the wiki, from the title index or the saved copy."""
+        return self.titles.ready or self.saved_titles is not None
+
+    def resolve_title(self, text: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Resolve text to the page it refers to without asking the wiki.
+
+        :param text: the title or query to resolve.
+        :returns: a (canonical title, fragment) tuple, or None if no page matches."""
+        if self.titles.ready:
+            return self.titles.resolve(text)
+        if self.saved_titles is not None:
+            return self.saved_titles.resolve(text)
+        return None
+
+    @property
+    def indexes_ready(self) -> bool:
+        """Whether the title, section and full-text indexes have been built."""
+        return self.titles.ready and self.sections.ready and self.text_index.ready
+
+    async def refresh_indexes(self) -> None:
+        """Rebuild every local index of the wiki from scratch."""
+        started = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        await self.refresh_title_index()
+        await self.refresh_page_index()
+        self.refresh_prefix_index()
+        await self.save_title_index()
+        # Changes made while the indexes were being built are picked up by the next sync
+        if self._sync_cursor is None:
+            self._save_sync_cursor({"timestamp": started, "rcid": 0})
+
+    async def load_dump(self, path: pathlib.Path) -> None:
+        """Build every local index from a MediaWiki XML dump instead of the API.
+
+        The dump is streamed in a worker thread, and the recentchanges sync continues from its newest revision.
 
-    def to_page(self, page_id) -> MediaWikiPage:
-        """Convert a page ID to a MediaWikiPage.
+        :param path: the path to the dump."""
+        newest = await asyncio.to_thread(self._load_dump, path)
+        self.refresh_prefix_index()
+        await self.save_title_index()
+        if newest:
+            self._save_sync_cursor({"timestamp": newest, "rcid": 0})
+
+    def _load_dump(self, path: pathlib.Path) -> str:
+        """Build every local index from a MediaWiki XML dump.
+
+        :returns: the timestamp of the newest revision in the dump."""
+        titles = []
+        redirects = []
+        sections = []
+        texts = []
+        newest = ""
+        for page in iter_dump_pages(path):
+            newest = max(newest, page.timestamp)
+            if page.ns not in WIKI_NAMESPACES:
+                continue
+            if page.redirect is not None:
+                redirects.append((page.title, page.redirect, page.redirect_fragment))
+                continue
+            titles.append(page.title)
+            sections.append((page.title, parse_headings(page.text)))
+            texts.append((page.pageid, page.ns, page.title, wikitext_to_plaintext(page.text)))
+        self.titles.rebuild(titles, redirects)
+        self.sections.rebuild(sections)
+        self.text_index.rebuild(texts)
+        self.related.rebuild(self.text_index.term_counts())
+        return newest
+
+    async def refresh_titles(self, titles: Iterable[str]) -> None:
+        """Update the local indexes for specific pages, such as those which were recently changed.
+
+        :param titles: the titles of the pages to update."""
+        titles = list(titles)
+        for title, page in (await self.wiki.pages(titles)).items():
+            if page is None:
+                self.titles.remove(title)
+            elif page.title == title:
+                self.titles.add_page(title)
+            else:
+                self.titles.add_redirect(title, page.title, page.fragment)
+        await self.refresh_pages(titles)
+
+    async def sync_recent_changes(self) -> Set[str]:
+        """Apply every change made to the wiki since the last sync to the local indexes.
+
+        :returns: the titles of every page that was edited, created, moved or deleted."""
+        if self._sync_cursor is None:
+            return set()
+        cursor = dict(self._sync_cursor)
+        changed = set()
+        async for change in self.wiki.recent_changes(cursor["timestamp"], WIKI_NAMESPACES):
+            # The start of the feed is inclusive, so skip changes seen by the previous sync
+            if change["timestamp"] == self._sync_cursor["timestamp"] and change["rcid"] <= self._sync_cursor["rcid"]:
+                continue
+            changed.add(change["title"])
+            if change.get("logtype") == "move" and "target_title" in change.get("logparams", {}):
+                changed.add(change["logparams"]["target_title"])
+            cursor = {"timestamp": change["timestamp"], "rcid": change["rcid"]}
+        if len(changed) > 0:
+            await self.refresh_titles(changed)
+            self.refresh_prefix_index()
+            await self._invalidate_links(changed)
+            # Any edit may change which pages match a search
+            self.advanced_search_cache.clear()
+            changed_titles = {normalise_title(title) for title in changed}
+            self.summary_cache.invalidate_where(lambda key, _: key in changed_titles)
+            await self.save_title_index()
+        self._save_sync_cursor(cursor)
+        return changed
+
+    async def _invalidate_links(self, titles: Set[str]) -> None:
+        """Remove cached links that may have been affected by changes to the given pages.
+
+        Misses are always removed, as a created or moved page may now match them.
+
+        :param titles: the titles of the pages that changed."""
+        changed = {normalise_title(title) for title in titles}
+        self.link_cache.invalidate_where(lambda key, link: link is None or key in changed or
+                                         self.link_title(link) in changed)
+        if self.store is not None:
+            await self.store.invalidate(changed)
+
+    def _load_sync_cursor(self) -> Optional[dict]:
+        """Load the recentchanges position saved by a previous sync, if any."""
+        if self._sync_state_path is None:
+            return None
+        try:
+            with self._sync_state_path.open("r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _save_sync_cursor(self, cursor: dict) -> None:
+        """Save the recentchanges position so the next sync continues from it, even after a restart."""
+        self._sync_cursor = cursor
+        if self._sync_state_path is None:
+            return
+        self._sync_state_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._sync_state_path.open("w") as f:
+            json.dump(cursor, f)
+
+    def link_title(self, link: str) -> Optional[str]:
+        """Find the normalised title of the page a link points to.
+
+        Links to the editor for a page that does not exist yet point to that page, so they are invalidated once
+        it is created.
+
+        :param link: a link to a page or section on the wiki.
+        :returns: the normalised title, or None if the link does not point to a wiki page."""
+        title = self._link_page_title(link)
+        if title is None and link.startswith(self.wiki_base_url) and link.endswith("?action=edit&redlink=1"):
+            title = urllib.parse.unquote(link[len(self.wiki_base_url):].split("?")[0]).replace("_", " ")
+        return normalise_title(title) if title is not None else None
+
+    def _link_page_title(self, link: str) -> Optional[str]:
+        """Find the title of the page a link points to, as it appears in the link."""
+        path = link.split("#")[0].split("?")[0]
+        if not path.startswith(f"{self.wiki_base_url}wiki/"):
+            return None
+        return urllib.parse.unquote(path[len(f"{self.wiki_base_url}wiki/"):]).replace("_", " ")
+
+    async def page_summaries(self, links: List[str]) -> Dict[str, PageSummary]:
+        """Get the summaries of the pages that links point to, fetching every uncached one in one batch.
+
+        :param links: links to pages or sections on the wiki.
+        :returns: a dict mapping each link to the summary of its page, leaving out links to pages without one."""
+        titles = {link: self._link_page_title(link) for link in links}
+        results = {}
+        uncached = {}
+        for link, title in titles.items():
+            if title is None:
+                continue
+            summary = self.summary_cache.get(normalise_title(title))
+            if summary is not None:
+                results[link] = summary
+            else:
+                uncached.setdefault(title, []).append(link)
+        if len(uncached) > 0:
+            for title, summary in (await self.wiki.page_summaries(list(uncached))).items():
+                # A summary without an introduction or a thumbnail is no better than the wiki's own link preview
+                if summary is None or (summary.extract is None and summary.thumbnail is None):
+                    continue
+                self.summary_cache.set(normalise_title(title), summary)
+                results.update((link, summary) for link in uncached[title])
+        return results
+
+    def indexed_link(self, text: str) -> Optional[str]:
+        """Find a link to the page with the given title using only the title index.
+
+        :param text: the title to look up.
+        :returns: a link to the page, or None if it is not in the index."""
+        entry = self.resolve_title(text)
+        return None if entry is None else self.title_url(*entry)
+
+    async def to_page(self, page_id) -> WikiPage:
+        """Convert a page ID to a WikiPage.
 
         :param page_id: the ID of the page to return.
         :returns: the page requested."""
-        return self.wiki.page(page_id, auto_suggest=False)
+        return await self.wiki.page(page_id)
 
-    def search(self, text: str, limit=10) -> List[str]:
+    async def search(self, text: str, limit=10) -> List[str]:
         """Search the wiki pages.
 
         Will return the search results, not pages.
@@ -28,72 +497,208 @@ class WikiInterface:
         :param text: the page to search for.
         :param limit: the number of results to return.
         :returns: a list of search results."""
-        results = self.wiki.search(text[:self.max_query_len], results=limit)
+        return await self.single_flight.do(("search", " ".join(text.split()), limit),
+                                           lambda: self._search(text, limit))
+
+    async def _search(self, text: str, limit: int) -> List[str]:
+        """Search the wiki pages, without sharing the request with concurrent searches."""
+        results = await self.wiki.search(text[:self.max_query_len], results=limit)
         if text in results:
             return results
         section_results = [result for result in results if text.lower() in result.lower()]
         for result in results:
-            section_results.extend(self.section_search(self.to_page(result), text))
             if len(section_results) >= limit:
                 break
+            section_results.extend(await self.section_search(result, text))
         return section_results[:limit]
 
-    def page_search(self, text: str, exact: bool = False) -> MediaWikiPage:
+    async def page_search(self, text: str, exact: bool = False) -> Optional[WikiPage]:
         """Searches for a page to return.
 
         Will return the first result as a page.
 
         :param text: the page to search for.
         :param exact: when enabled, will only search for an exact match and not search for pages with related content.
-        :returns: the page requested."""
-        page = None
+        :returns: the page requested, or None if nothing is found."""
         try:
-            page = self.to_page(text)
-        except mediawiki.PageError:
+            return await self.to_page(text)
+        except PageError:
             if exact:
-                return page
-            page = self.to_page(self.search(text)[0])
-            page.summarize()
-        finally:
-            return page
+                return None
+        results = await self.search(text)
+        if len(results) == 0:
+            return None
+        try:
+            return await self.to_page(results[0])
+        except PageError:
+            return None
 
-    def section_search(self, page: MediaWikiPage, text: str) -> List[str]:
+    async def section_search(self, title: str, text: str) -> List[str]:
         """Searches a page for a specific section.
 
-        :param page: the page to search.
+        :param title: the title of the page to search.
         :param text: the section to search for on the page.
         :returns: a list of result strings in the format `Page#Section`."""
-        # TODO: find a better way to detect a page with no sections
+        if self.sections.ready:
+            return self.sections.find(title, text)
         try:
-            return [f"{page.title}#{section.replace(' ', '_')}" for section in page.sections if text.lower() in section.lower()]
-        except IndexError:
+            sections = await self.wiki.sections(title)
+        except PageError:
             return []
+        return [f"{title}#{section.replace(' ', '_')}" for section in sections if text.lower() in section.lower()]
+
+    async def batch_page_or_section_search(self, texts: List[str],
+                                           limit: Optional[int] = None) -> Dict[str, Optional[str]]:
+        """Searches for pages or sections matching each of the provided texts.
+
+        Exact titles are all resolved together in as few requests as possible, and only the texts that do not
+        match a page fall back to searching.
+
+        :param texts: the pages or sections to search for.
+        :param limit: stop searching for fallback results once this many links have been found.
+        :returns: a dict mapping each text to a link to its page or section, or None if nothing is found, leaving
+            out texts that were not searched for because the limit was reached."""
+        # Searches with a limit may leave texts out, so they are only shared with searches with the same limit
+        keys = {text: ("link", limit, normalise_title(text)) for text in texts}
+        key_texts = {key: text for text, key in keys.items()}
+
+        async def resolve(own_keys):
+            results = await self._batch_page_or_section_search([key_texts[key] for key in own_keys], limit)
+            return {key: results[key_texts[key]] for key in own_keys if key_texts[key] in results}
 
-    def page_or_section_search(self, text: str) -> str:
-        """Searches for a page or section matching the provided text.
+        results = await self.single_flight.do_many(list(keys.values()), resolve)
+        return {text: results[key] for text, key in keys.items() if key in results}
+
+    async def _batch_page_or_section_search(self, texts: List[str],
+                                            limit: Optional[int]) -> Dict[str, Optional[str]]:
+        """Searches for many pages or sections, without sharing the requests with concurrent searches."""
+        if self.titles_available:
+            results = {text: self.indexed_link(text) for text in texts}
+        else:
+            results = {text: page.link for text, page in (await self.wiki.pages(texts)).items() if page is not None}
+        results = {text: link for text, link in results.items() if link is not None}
+        remaining = [text for text in texts if text not in results]
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
+
+        async def search_for_link(text: str) -> Optional[str]:
+            async with semaphore:
+                return await self._search_for_link(text)
+
+        # Search concurrently, in rounds of only as many texts as could still be needed to reach the limit
+        while len(remaining) > 0:
+            # Queries linking to the same page, such as a redirect and its target, are only replied with once
+            found = len({link for link in results.values() if link is not None})
+            count = len(remaining) if limit is None else max(0, limit - found)
+            if count == 0:
+                break
+            round_texts, remaining = remaining[:count], remaining[count:]
+            links = await asyncio.gather(*(search_for_link(text) for text in round_texts))
+            results.update(zip(round_texts, links))
+        # Texts left once the limit is reached were never searched for, so are left out rather than reported missing
+        return {text: results[text] for text in texts if text in results}
+
+    async def _search_for_link(self, text: str) -> Optional[str]:
+        """Searches for the best page or section matching text that is not an exact title.
 
         :param text: the page or section to search for.
-        :returns: a link to the requested page or section, or None if nothing is found."""
-        page = self.page_search(text, exact=True)
-        if page is not None:
-            return page.url
-        results = self.search(text, limit=5)
+        :returns: a link to the best page or section, or None if nothing is found."""
+        # Most near misses are typos in a title, which can be corrected without asking the wiki
+        if self.titles.ready and "#" not in text:
+            match = self.titles.fuzzy_resolve(text)
+            if match is not None and match[2] >= MIN_FUZZY_CONFIDENCE:
+                return self.title_url(match[0], match[1])
+        results = await self.search(text, limit=5)
         if len(results) == 0:
             return None
+        if self.titles.ready and results[0].split("#")[0] in self.titles:
+            title, _, fragment = results[0].partition("#")
+            return self.title_url(self.titles.resolve(title)[0], fragment)
         if "#" not in results[0]:
-            return self.page_search(results[0]).url
-        page = self.page_search(results[0][:results[0].index("#")])
-        return page.url + results[0][results[0].index("#"):]
+            page = await self.page_search(results[0])
+            return page.url if page is not None else None
+        page = await self.page_search(results[0][:results[0].index("#")])
+        return page.url + results[0][results[0].index("#"):] if page is not None else None
+
+    async def search_result_link(self, title: str) -> Optional[str]:
+        """Find the link for a search result, building it locally rather than asking the wiki where possible.
 
-    def advanced_search(self, text: str, limit=None) -> List[SearchResult]:
+        Search results carry their page's canonical title, so the link can be built from it once the title is
+        confirmed to still exist.
+
+        :param title: the title of the search result.
+        :returns: a link to the page, or None if it no longer exists."""
+        if not self.titles_available:
+            return self.title_url(title)
+        entry = self.resolve_title(title)
+        if entry is not None:
+            return self.title_url(*entry)
+        # The page may have been created after the title index was last updated
+        page = await self.page_search(title, exact=True)
+        return page.url if page is not None else None
+
+    async def advanced_search(self, text: str, limit=None) -> SearchResultPager:
         """Searches for text with snippets of pages where the text is found
 
+        Searches are answered from the local full-text index when it is ready. The wiki is only asked about queries
+        using syntax the local index does not support, or that it finds nothing for, as it only matches whole words
+        where the wiki's search also matches other forms of them. Results from the wiki are fetched a chunk at a
+        time as they are paged through, starting with the first chunk.
+
         :param text: the page to search for.
-        :param limit: the number of results to fetch.
-        :returns: a list of SearchResult objects."""
+        :param limit: the maximum number of results to page through.
+        :returns: a pager over the SearchResult objects."""
+        query = text[:self.max_query_len]
+        if self.text_index.ready:
+            # Ranking every page can take a while, so it is kept off the event loop
+            async with self._text_index_lock:
+                found = await asyncio.to_thread(self.text_index.search, query, WIKI_NAMESPACES, limit or 500)
+            # When the wiki is unavailable, finding nothing locally is better than failing
+            if found is not None and (len(found[0]) > 0 or not self.available):
+                return self._local_search_pager(*found)
+        cached = self.advanced_search_cache.get((query, limit))
+        if cached is not None:
+            pager = self._advanced_search_pager(query, limit)
+            pager.prefill([SearchResult.from_tuple(result) for result in cached[1]], cached[0])
+            return pager
+        return await self.single_flight.do(("advanced_search", query, limit),
+                                           lambda: self._advanced_search(query, limit))
+
+    def _local_search_pager(self, titles: List[str], matched_terms: Set[str]) -> SearchResultPager:
+        """Make a pager which builds the results of a local search a chunk at a time, starting with the first."""
+        async def fetch(offset: int, count: int):
+            return self.text_index.results(titles[offset:offset + count], matched_terms), len(titles)
+
+        pager = SearchResultPager(fetch, chunk_size=ADVANCED_SEARCH_CHUNK_SIZE, max_results=len(titles))
+        pager.prefill(self.text_index.results(titles[:pager.chunk_size], matched_terms), len(titles))
+        return pager
 
-        # Revo wiki Guide namespace ID = 3000
-        return self.wiki.advanced_search(query=text[:self.max_query_len], limit=limit,
-                                         srprop=["snippet","sectionsnippet"], srnamespace=[0, 3000])
+    def _advanced_search_pager(self, query: str, limit: Optional[int]) -> SearchResultPager:
+        """Make a pager which fetches the results of an advanced search from the wiki."""
+        async def fetch(offset: int, count: int):
+            return await self.wiki.advanced_search(query=query, limit=count, offset=offset,
+                                                   srprop=["snippet", "sectionsnippet"], srnamespace=WIKI_NAMESPACES)
 
+        return SearchResultPager(fetch, chunk_size=ADVANCED_SEARCH_CHUNK_SIZE, max_results=limit or 500)
 
+    async def _advanced_search(self, query: str, limit: Optional[int]) -> SearchResultPager:
+        """Searches for text with snippets, without sharing the request with concurrent searches."""
+        pager = self._advanced_search_pager(query, limit)
+        # Only the first chunk is cached, as that is all most searches look at
+        store_key = f"{limit}:{query}"
+        stored = await self.store.get_search(store_key) if self.store is not None else None
+        age = time.time() - stored[1] if stored is not None else 0
+        # Results stored before searches were paged are a plain list, and are fetched again
+        if stored is not None and isinstance(stored[0], dict) and age < self.advanced_search_cache.ttl:
+            pager.prefill([SearchResult.model_validate(result) for result in stored[0]["results"]],
+                          stored[0]["total_hits"])
+        else:
+            age = 0
+            await pager.load(0, pager.chunk_size)
+            if self.store is not None:
+                self.store.put_search(store_key, {"results": [result.model_dump() for result in
+                                                              pager.loaded(0, pager.chunk_size)],
+                                                  "total_hits": pager.total_hits})
+        # Results loaded from disk expire when they would have if they had stayed in memory
+        self.advanced_search_cache.set((query, limit), (pager.total_hits, tuple(
+            result.to_tuple() for result in pager.loaded(0, pager.chunk_size))), age=age)
+        return pager
@@ -4,6 +4,21 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
+from helpers.rate_limiter import WikiUnavailableError
+
+
+def _unwrap_error(err: Exception) -> Exception:
+    """Find the exception that caused an error, through every layer discord.py wrapped it in.
+
+    Hybrid commands run as slash commands wrap it twice, in a HybridCommandError around a CommandInvokeError.
+
+    :param err: The exception that was raised.
+    :returns: The original exception.
+    """
+    while getattr(err, "original", None) is not None:
+        err = err.original
+    return err
+
 
 async def handle_message_command_error(ctx: commands.Context, err: commands.CommandError):
     """Handles errors raised during execution of message commands.
@@ -15,7 +30,7 @@ async def handle_message_command_error(ctx: commands.Context, err: commands.Comm
     if hasattr(ctx.command, "on_error"):
         return
 
-    error = getattr(err, "original", err)
+    error = _unwrap_error(err)
 
     if isinstance(error, commands.CommandNotFound):
         return
@@ -84,6 +99,10 @@ async def handle_message_command_error(ctx: commands.Context, err: commands.Comm
         await ctx.send("I do not have permission to perform an action for that command")
         return
 
+    if isinstance(error, (WikiUnavailableError, TimeoutError)):
+        await ctx.send("The wiki is not responding right now, please try again later.")
+        return
+
     print("Error Caught:")
     print(error)
 
@@ -98,7 +117,7 @@ async def handle_app_command_error(interaction: discord.Interaction, err: app_co
     if hasattr(interaction.command, "on_error"):
         return
 
-    error = getattr(err, "original", err)
+    error = _unwrap_error(err)
 
     print("Error Caught:")
     print(error)
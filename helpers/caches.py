@@ -0,0 +1,408 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Mapping, Optional, TypeVar
+from urllib.parse import urlencode
+
+from helpers.wiki_index import normalise_title
+
+T = TypeVar("T")
+
+# Marks keys the work left out of its results
+_NO_RESULT = object()
+
+
+@dataclass
+class CacheEntry:
+    """A cached value and the time it stops being fresh."""
+    value: Any
+    expires_at: float
+    # Whether the entry had stopped being fresh when it was last looked up
+    stale: bool = False
+
+
+class LinkCache:
+    """A bounded LRU cache of wiki lookups.
+
+    Hits and misses (cached as None) have separate lifetimes, so a miss expires quickly once its page is created.
+    Queries are normalised, so `[[ap_upgrades]]` and `[[AP  Upgrades]]` share an entry.
+    Entries are kept for a while after they expire, so callers that can refresh them in the background may
+    still use them.
+    """
+    def __init__(self, max_entries: int = 5000, ttl: float = 24 * 60 * 60, negative_ttl: float = 30 * 60,
+                 stale_ttl: float = 7 * 24 * 60 * 60, clock: Callable[[], float] = time.monotonic):
+        """Initialise the cache.
+
+        :param max_entries: the number of entries to keep before evicting the least recently used.
+        :param ttl: how long a found link stays fresh, in seconds.
+        :param negative_ttl: how long a miss stays fresh, in seconds.
+        :param stale_ttl: how long an entry can still be used as stale after it stops being fresh, in seconds.
+        :param clock: the function used to tell the time, in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalise_key(query: str) -> str:
+        """Normalise a query into a cache key.
+
+        :param query: the query to normalise.
+        :returns: the cache key."""
+        return normalise_title(query)
+
+    def get(self, query: str, allow_stale: bool = False) -> Optional[CacheEntry]:
+        """Get the cached result of a query.
+
+        :param query: the query to look up.
+        :param allow_stale: whether to return an entry that is no longer fresh, which the caller should refresh.
+        :returns: the cache entry, whose value is None for a cached miss, or None if the query is not cached."""
+        key = self.normalise_key(query)
+        entry = self._entries.get(key)
+        now = self._clock()
+        if entry is not None and entry.expires_at + self.stale_ttl <= now:
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is not None:
+            entry.stale = entry.expires_at <= now
+        if entry is None or (entry.stale and not allow_stale):
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        if entry.stale:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, query: str, value: Optional[str], age: float = 0) -> Optional[CacheEntry]:
+        """Cache the result of a query.
+
+        :param query: the query that was looked up.
+        :param value: the link that was found, or None if nothing was found.
+        :param age: how long ago the result was found, in seconds, for results loaded from elsewhere.
+        :returns: the new cache entry, or None if the result is too old to be used even as stale."""
+        key = self.normalise_key(query)
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if age >= ttl + self.stale_ttl:
+            return None
+        entry = CacheEntry(value, self._clock() + ttl - age, stale=age >= ttl)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def invalidate(self, query: str) -> None:
+        """Remove a query from the cache.
+
+        :param query: the query to remove."""
+        self._entries.pop(self.normalise_key(query), None)
+
+    def invalidate_where(self, predicate: Callable[[str, Optional[str]], bool]) -> int:
+        """Remove every entry matching a predicate.
+
+        :param predicate: called with each normalised key and cached value, returning True to remove the entry.
+        :returns: the number of entries removed."""
+        to_remove = [key for key, entry in self._entries.items() if predicate(key, entry.value)]
+        for key in to_remove:
+            del self._entries[key]
+        return len(to_remove)
+
+    def clear(self) -> None:
+        """Remove every entry from the cache."""
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the size of the cache and how well it is performing.
+
+        :returns: a dict of statistic names to values."""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": f"{(self.hits + self.stale_hits) / lookups:.1%}" if lookups > 0 else "n/a",
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
+
+
+class ExpiringCache:
+    """A bounded LRU cache whose entries expire a fixed time after they are set."""
+    def __init__(self, max_entries: int = 256, ttl: float = 30 * 60, clock: Callable[[], float] = time.monotonic):
+        """Initialise the cache.
+
+        :param max_entries: the number of entries to keep before evicting the least recently used.
+        :param ttl: how long an entry stays fresh, in seconds.
+        :param clock: the function used to tell the time, in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get a cached value.
+
+        :param key: the key the value was cached under.
+        :returns: the value, or None if it is not cached or has expired."""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= self._clock():
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def set(self, key: Hashable, value: Any, age: float = 0) -> None:
+        """Cache a value.
+
+        :param key: the key to cache the value under.
+        :param value: the value to cache.
+        :param age: how long ago the value was found, such as when it was loaded from disk, in seconds."""
+        self._entries[key] = CacheEntry(value, self._clock() + self.ttl - age)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate_where(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Remove every entry matching a predicate.
+
+        :param predicate: called with each key and cached value, returning True to remove the entry.
+        :returns: the number of entries removed."""
+        to_remove = [key for key, entry in self._entries.items() if predicate(key, entry.value)]
+        for key in to_remove:
+            del self._entries[key]
+        self.invalidations += len(to_remove)
+        return len(to_remove)
+
+    def clear(self) -> None:
+        """Remove every entry from the cache."""
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the size of the cache and how well it is performing.
+
+        :returns: a dict of statistic names to values."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / lookups:.1%}" if lookups > 0 else "n/a",
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
+
+
+class SingleFlight:
+    """Shares in-flight work between concurrent callers asking for the same keys.
+
+    The first caller for a key does the work, and anyone asking for that key before it finishes waits for
+    the same result instead of repeating the request.
+    """
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        """Get the result for a key, sharing the call with any concurrent callers.
+
+        :param key: identifies the work, such as a normalised query.
+        :param function: does the work if it is not already in flight.
+        :returns: the result of the work."""
+        async def call(_keys: List[Hashable]) -> Dict[Hashable, T]:
+            return {key: await function()}
+        return (await self.do_many([key], call))[key]
+
+    async def do_many(self, keys: List[Hashable],
+                      function: Callable[[List[Hashable]], Awaitable[Dict[Hashable, T]]]) -> Dict[Hashable, T]:
+        """Get the results for many keys, sharing the work for each key with any concurrent callers.
+
+        :param keys: identify each piece of work.
+        :param function: does the work for the keys that are not already in flight, in one call, returning a
+            dict of each key to its result. Keys it leaves out are left out of the results of every caller.
+        :returns: a dict of each key to its result."""
+        loop = asyncio.get_running_loop()
+        waiting = {key: self._in_flight[key] for key in dict.fromkeys(keys) if key in self._in_flight}
+        owned = {key: loop.create_future() for key in dict.fromkeys(keys) if key not in waiting}
+        self._in_flight.update(owned)
+        self.calls += len(owned)
+        self.shared += len(waiting)
+        try:
+            results = await function(list(owned)) if len(owned) > 0 else {}
+            for key, future in owned.items():
+                future.set_result(results.get(key, _NO_RESULT))
+        except BaseException as e:
+            for future in owned.values():
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    # Mark the exception as retrieved, as there may be nobody else waiting for it
+                    future.exception()
+            raise
+        finally:
+            for key, future in owned.items():
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+        for key, future in waiting.items():
+            results[key] = await asyncio.shield(future)
+        return {key: results[key] for key in keys if results.get(key, _NO_RESULT) is not _NO_RESULT}
+
+    def stats(self) -> Dict[str, Any]:
+        """Get how much work has been shared between callers.
+
+        :returns: a dict of statistic names to values."""
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "shared_calls": self.shared
+        }
+
+
+@dataclass
+class _StoredResponse:
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class ResponseCache:
+    """A bounded LRU cache of HTTP response bodies, revalidated with conditional requests.
+
+    Only responses with an `ETag` or `Last-Modified` header are stored, as there is no way to check whether
+    others are still current. A `304 Not Modified` answer reuses the stored body instead of downloading it again.
+    """
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 32 * 1024 * 1024):
+        """Initialise the cache.
+
+        :param max_entries: the number of responses to keep before evicting the least recently used.
+        :param max_bytes: the total size of the stored bodies to keep before evicting the least recently used.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, _StoredResponse] = OrderedDict()
+        self._size = 0
+        self.requests = 0
+        self.revalidated = 0
+        # Bytes not downloaded because a stored body was still current, or because the response was compressed
+        self.bytes_saved_revalidating = 0
+        self.bytes_saved_compressing = 0
+
+    @staticmethod
+    def key(params: Mapping[str, Any]) -> str:
+        """Normalise request parameters into a cache key, so the order they were given in does not matter.
+
+        :param params: the query parameters of the request.
+        :returns: the cache key."""
+        return urlencode(sorted((str(name), str(value)) for name, value in params.items()))
+
+    def conditional_headers(self, key: str) -> Dict[str, str]:
+        """Get the headers asking the server to only send a response if it has changed since it was stored.
+
+        :param key: the cache key of the request.
+        :returns: the conditional headers, which are empty if nothing is stored."""
+        self.requests += 1
+        stored = self._entries.get(key)
+        if stored is None:
+            return {}
+        headers = {}
+        if stored.etag is not None:
+            headers["If-None-Match"] = stored.etag
+        if stored.last_modified is not None:
+            headers["If-Modified-Since"] = stored.last_modified
+        return headers
+
+    def not_modified(self, key: str) -> Optional[bytes]:
+        """Get the stored body of a response the server said has not changed.
+
+        :param key: the cache key of the request.
+        :returns: the stored body, or None if it has since been evicted."""
+        stored = self._entries.get(key)
+        if stored is None:
+            return None
+        self._entries.move_to_end(key)
+        self.revalidated += 1
+        self.bytes_saved_revalidating += len(stored.body)
+        return stored.body
+
+    def store(self, key: str, body: bytes, headers: Mapping[str, str]) -> None:
+        """Store a response, if it can be revalidated.
+
+        :param key: the cache key of the request.
+        :param body: the decoded body of the response.
+        :param headers: the headers of the response."""
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        self._remove(key)
+        if (etag is None and last_modified is None) or len(body) > self.max_bytes:
+            return
+        self._entries[key] = _StoredResponse(body, etag, last_modified)
+        self._size += len(body)
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def record_transfer(self, transferred: Optional[int], decoded: int) -> None:
+        """Record how much a response was compressed by.
+
+        :param transferred: the number of bytes sent by the server, or None if it is not known.
+        :param decoded: the number of bytes after decompression."""
+        if transferred is not None and transferred < decoded:
+            self.bytes_saved_compressing += decoded - transferred
+
+    def _remove(self, key: str) -> None:
+        stored = self._entries.pop(key, None)
+        if stored is not None:
+            self._size -= len(stored.body)
+
+    def clear(self) -> None:
+        """Remove every stored response."""
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the size of the cache and how much downloading it has saved.
+
+        :returns: a dict of statistic names to values."""
+        return {
+            "responses": len(self._entries),
+            "stored_bytes": self._size,
+            "requests": self.requests,
+            "revalidated": self.revalidated,
+            "bytes_saved_revalidating": self.bytes_saved_revalidating,
+            "bytes_saved_compressing": self.bytes_saved_compressing
+        }
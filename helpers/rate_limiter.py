@@ -0,0 +1,178 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class WikiUnavailableError(Exception):
+    """Raised when the wiki could not answer a request, such as when it kept failing after every retry."""
+
+
+class CircuitOpenError(WikiUnavailableError):
+    """Raised instead of making a request while the circuit breaker is open."""
+    def __init__(self, retry_after: float):
+        super().__init__(f"The wiki is unavailable, retry in {retry_after:.0f}s.")
+        self.retry_after = retry_after
+
+
+class RetryableError(Exception):
+    """Raised by a request that failed in a way that may succeed if retried, such as HTTP 429 or 503.
+
+    Callers of `RateLimiter.run` never see it, as it is raised as a WikiUnavailableError once the retries run out.
+    """
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Limits how often requests are started, while allowing short bursts."""
+    def __init__(self, rate: float, capacity: int, clock: Callable[[], float] = time.monotonic):
+        """Initialise the bucket.
+
+        :param rate: the number of requests allowed per second, on average.
+        :param capacity: the number of requests allowed in a burst.
+        :param clock: the function used to tell the time, in seconds.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        """Wait until a request may be started."""
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+
+class CircuitBreaker:
+    """Stops requests being made to a service that keeps failing, so callers can give up immediately.
+
+    After `failure_threshold` consecutive failures the circuit opens and every request is refused for
+    `reset_timeout` seconds. A single trial request is then let through, closing the circuit if it succeeds.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def is_open(self) -> bool:
+        """Whether requests are currently being refused."""
+        return self.retry_after() > 0 or self._trial_in_flight
+
+    def retry_after(self) -> float:
+        """The number of seconds until a trial request will be let through."""
+        if self._opened_at is None:
+            return 0
+        return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def allow(self) -> bool:
+        """Check whether a request may be made, claiming the trial request if the circuit is half-open."""
+        if self._opened_at is None:
+            return True
+        if self.retry_after() > 0 or self._trial_in_flight:
+            return False
+        self._trial_in_flight = True
+        return True
+
+    def release_trial(self) -> None:
+        """Let another trial request through, as the current one was abandoned without a result."""
+        self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._trial_in_flight or self._failures >= self.failure_threshold:
+            self._opened_at = self._clock()
+        self._trial_in_flight = False
+
+
+class RateLimiter:
+    """Shared limits for every request made to the wiki.
+
+    Requests are started at a steady rate with a cap on how many run at once. Failed requests are retried with
+    exponential backoff, honouring any `Retry-After` the wiki sends, within an overall deadline. Requests that still
+    fail, or fail in a way that is not worth retrying, count towards a circuit breaker.
+    """
+    def __init__(self, rate: float = 5, burst: int = 10, max_in_flight: int = 4, max_retries: int = 3,
+                 deadline: float = 15, base_delay: float = 0.5, breaker: Optional[CircuitBreaker] = None):
+        """Initialise the limiter.
+
+        :param rate: the number of requests started per second, on average.
+        :param burst: the number of requests that may be started at once after a quiet period.
+        :param max_in_flight: the number of requests that may run at once.
+        :param max_retries: the number of times a failed request is retried.
+        :param deadline: the total time allowed for a request and its retries, in seconds.
+        :param base_delay: the delay before the first retry, doubled for each retry after, in seconds.
+        :param breaker: the circuit breaker to use, or None for the default.
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def run(self, request: Callable[[], Awaitable[T]]) -> T:
+        """Make a request within the limits.
+
+        :param request: makes the request; called again for each retry.
+        :returns: the result of the request.
+        :raises CircuitOpenError: if the circuit breaker is open.
+        :raises WikiUnavailableError: if the request failed after every retry, or failed in a way not worth retrying.
+        :raises TimeoutError: if the request and its retries took longer than the deadline."""
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.breaker.retry_after())
+        try:
+            async with asyncio.timeout(self.deadline):
+                result = await self._run_with_retries(request)
+        except RetryableError as e:
+            self.breaker.record_failure()
+            raise WikiUnavailableError(str(e)) from e
+        except (WikiUnavailableError, TimeoutError):
+            self.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.release_trial()
+            raise
+        except Exception:
+            # Errors the wiki answered with, such as a missing page, show it is working
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _run_with_retries(self, request: Callable[[], Awaitable[T]]) -> T:
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                async with self._semaphore:
+                    return await request()
+            except RetryableError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after
+            if delay is None:
+                # Jitter stops every waiting request retrying at the same moment
+                delay = self.base_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            await asyncio.sleep(delay)
@@ -0,0 +1,174 @@
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from helpers.search_engine import tokenise
+
+
+class RelatedPages:
+    """A precomputed table of the pages most similar to each page, by cosine similarity of TF-IDF vectors.
+
+    The vectors are held as a sparse matrix in compressed column form, so the similarity of one page to every other
+    page is a single vectorised gather over the columns of its terms. Changes to a few pages only recompute the
+    neighbours of those pages and of the pages whose neighbours they could change.
+    """
+    # Pages less similar than this are never suggested
+    MIN_SIMILARITY = 0.05
+
+    def __init__(self, neighbours: int = 5):
+        """Initialise the table.
+
+        :param neighbours: the number of related pages stored for each page.
+        """
+        self.neighbours = neighbours
+        self._vocabulary: Dict[str, int] = {}
+        self._words: List[str] = []
+        self._document_frequencies: Counter = Counter()
+        # Map each title to the IDs of its terms and their normalised weights
+        self._vectors: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._related: Dict[str, List[Tuple[str, float]]] = {}
+        self._titles: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._column_starts = np.zeros(1, dtype=np.int64)
+        self._column_rows = np.zeros(0, dtype=np.int64)
+        self._column_weights = np.zeros(0, dtype=np.float64)
+        # The number of pages changed by `update` since the last rebuild, as a measure of how far weights have drifted
+        self.changes_since_rebuild = 0
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+    def rebuild(self, documents: Iterable[Tuple[str, Counter]]) -> None:
+        """Replace the contents of the table, recomputing every page's neighbours.
+
+        :param documents: (title, term counts) tuples for every page."""
+        table = RelatedPages(self.neighbours)
+        documents = list(documents)
+        for _, term_counts in documents:
+            table._document_frequencies.update(term_counts.keys())
+        for title, term_counts in documents:
+            table._vectors[title] = table._vector(term_counts, len(documents))
+        table._build_matrix()
+        for title in table._vectors:
+            table._related[title] = table._top(title, table._similarities(*table._vectors[title]))
+        self.__dict__.update(table.__dict__)
+        self.ready = True
+
+    def update(self, changes: Dict[str, Optional[Counter]]) -> None:
+        """Add, replace or remove pages, recomputing only the neighbours that may have changed.
+
+        Term weights of unchanged pages keep the document frequencies of the last rebuild, which drift only slowly.
+
+        :param changes: a dict mapping each changed title to its term counts, or None if it was removed."""
+        for title, term_counts in changes.items():
+            old = self._vectors.pop(title, None)
+            if old is not None:
+                self._document_frequencies.subtract(self._words[term_id] for term_id in old[0])
+            self._related.pop(title, None)
+            if term_counts is not None:
+                self._document_frequencies.update(term_counts.keys())
+        for title, term_counts in changes.items():
+            if term_counts is not None:
+                self._vectors[title] = self._vector(term_counts, len(self._vectors) + 1)
+        self._build_matrix()
+        self.changes_since_rebuild += len(changes)
+
+        # Pages which listed a changed page may now list different pages
+        stale = {title for title, related in self._related.items()
+                 if any(other in changes for other, _ in related)}
+        for title, term_counts in changes.items():
+            if term_counts is None:
+                continue
+            similarities = self._similarities(*self._vectors[title])
+            self._related[title] = self._top(title, similarities)
+            # The changed page may now be similar enough to join the neighbours of other pages
+            thresholds = np.array([self._threshold(other) for other in self._titles])
+            stale.update(self._titles[row] for row in np.nonzero(similarities > thresholds)[0])
+        for title in stale - {title for title in changes if changes[title] is not None}:
+            if title in self._vectors:
+                self._related[title] = self._top(title, self._similarities(*self._vectors[title]))
+
+    def related(self, title: str) -> List[Tuple[str, float]]:
+        """Get the pages most similar to a page.
+
+        :param title: the title of the page.
+        :returns: (title, similarity) tuples, most similar first."""
+        return self._related.get(title, [])
+
+    def suggest(self, text: str, limit: int = 3) -> List[str]:
+        """Find the pages most similar to some text, such as a search query with no results.
+
+        :param text: the text to compare against every page.
+        :param limit: the maximum number of pages to suggest.
+        :returns: the titles of the most similar pages, most similar first."""
+        term_counts = Counter(term for term in tokenise(text) if term in self._vocabulary)
+        if len(term_counts) == 0:
+            return []
+        similarities = self._similarities(*self._vector(term_counts, len(self._vectors)))
+        return [title for title, _ in self._top(None, similarities, limit)]
+
+    def _vector(self, term_counts: Counter, document_count: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Weight a page's terms with sublinear TF-IDF, normalised to unit length."""
+        for term in term_counts:
+            if term not in self._vocabulary:
+                self._vocabulary[term] = len(self._words)
+                self._words.append(term)
+        term_ids = np.array([self._vocabulary[term] for term in term_counts], dtype=np.int64)
+        weights = np.array([(1 + math.log(count)) *
+                            (math.log((1 + document_count) / (1 + self._document_frequencies[term])) + 1)
+                            for term, count in term_counts.items()], dtype=np.float64)
+        norm = np.linalg.norm(weights)
+        return term_ids, weights / norm if norm > 0 else weights
+
+    def _build_matrix(self) -> None:
+        """Rebuild the sparse page-term matrix in compressed column form from the page vectors."""
+        self._titles = list(self._vectors)
+        self._rows = {title: row for row, title in enumerate(self._titles)}
+        if len(self._titles) == 0:
+            self._column_starts = np.zeros(len(self._vocabulary) + 1, dtype=np.int64)
+            self._column_rows = np.zeros(0, dtype=np.int64)
+            self._column_weights = np.zeros(0, dtype=np.float64)
+            return
+        term_ids = np.concatenate([self._vectors[title][0] for title in self._titles])
+        weights = np.concatenate([self._vectors[title][1] for title in self._titles])
+        rows = np.repeat(np.arange(len(self._titles)), [len(self._vectors[title][0]) for title in self._titles])
+        order = np.argsort(term_ids, kind="stable")
+        self._column_rows, self._column_weights = rows[order], weights[order]
+        column_lengths = np.bincount(term_ids, minlength=len(self._vocabulary))
+        self._column_starts = np.concatenate(([0], np.cumsum(column_lengths)))
+
+    def _similarities(self, term_ids: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """Compute the cosine similarity of a vector to every page, in the order of `_titles`."""
+        # Terms added since the matrix was built have no column yet
+        known = term_ids < len(self._column_starts) - 1
+        term_ids, weights = term_ids[known], weights[known]
+        starts = self._column_starts[term_ids]
+        lengths = self._column_starts[term_ids + 1] - starts
+        # Gather every entry of each term's column in one go
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        entries = offsets + np.arange(lengths.sum())
+        return np.bincount(self._column_rows[entries], weights=self._column_weights[entries] *
+                           np.repeat(weights, lengths), minlength=len(self._titles))
+
+    def _top(self, title: Optional[str], similarities: np.ndarray,
+             limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Find the most similar pages, other than the page itself."""
+        limit = limit if limit is not None else self.neighbours
+        if title is not None and title in self._vectors:
+            similarities = similarities.copy()
+            similarities[self._rows[title]] = 0
+        count = min(limit, len(similarities))
+        if count == 0:
+            return []
+        candidates = np.argpartition(-similarities, count - 1)[:count]
+        candidates = candidates[np.argsort(-similarities[candidates], kind="stable")]
+        return [(self._titles[row], float(similarities[row])) for row in candidates
+                if similarities[row] >= self.MIN_SIMILARITY]
+
+    def _threshold(self, title: str) -> float:
+        """The similarity a page must beat to join another page's neighbours."""
+        related = self._related.get(title, [])
+        return related[-1][1] if len(related) >= self.neighbours else self.MIN_SIMILARITY
@@ -0,0 +1,239 @@
+import bisect
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from helpers.wiki_index import _COMMENT_PATTERN, _LINK_PATTERN, _TAG_PATTERN, _TEMPLATE_PATTERN
+from helpers.wiki_lib_patch import SearchResult
+
+_REF_PATTERN = re.compile(r"<ref[^>/]*/>|<ref[^>]*>.*?</ref>", re.DOTALL | re.IGNORECASE)
+_FILE_PATTERN = re.compile(r"\[\[(?:File|Image|Category):[^\[\]]*(?:\[\[[^\]]*\]\][^\[\]]*)*\]\]", re.IGNORECASE)
+_EXTERNAL_LINK_PATTERN = re.compile(r"\[https?://[^\s\]]+\s*([^\]]*)\]")
+_TABLE_LINE_PATTERN = re.compile(r"^\s*(?:\{\||\|\}|\|-|\|\+).*$", re.MULTILINE)
+_TABLE_CELL_PATTERN = re.compile(r"^\s*[|!]|\|\||!!", re.MULTILINE)
+_FORMATTING_PATTERN = re.compile(r"'{2,}|^[=*#:;]+|=+\s*$|__[A-Z]+__", re.MULTILINE)
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Query syntax that is passed on to the wiki's own search instead of being handled locally
+_UNSUPPORTED_QUERY_PATTERN = re.compile(r"[\"~()\-+]|\b(?:AND|OR|NOT)\b|\w+:")
+
+SNIPPET_LENGTH = 150
+# Wildcard terms matching more words than this are passed on to the wiki's own search
+MAX_WILDCARD_EXPANSIONS = 100
+
+
+def wikitext_to_plaintext(wikitext: str) -> str:
+    """Strip the markup from wikitext, leaving roughly the text a reader would see.
+
+    :param wikitext: the wikitext of a page.
+    :returns: the plain text of the page."""
+    text = _COMMENT_PATTERN.sub("", wikitext)
+    text = _REF_PATTERN.sub("", text)
+    # Templates can be nested, so remove the innermost ones until none are left
+    previous = None
+    while previous != text:
+        previous, text = text, _TEMPLATE_PATTERN.sub("", text)
+    text = _FILE_PATTERN.sub("", text)
+    text = _LINK_PATTERN.sub(r"\1", text)
+    text = _EXTERNAL_LINK_PATTERN.sub(r"\1", text)
+    text = _TAG_PATTERN.sub("", text)
+    text = _TABLE_LINE_PATTERN.sub("", text)
+    text = _TABLE_CELL_PATTERN.sub(" ", text)
+    text = _FORMATTING_PATTERN.sub("", text)
+    return " ".join(text.split())
+
+
+def tokenise(text: str) -> List[str]:
+    """Split text into case-folded words.
+
+    :param text: the text to split.
+    :returns: the words in the text, in order."""
+    return _TOKEN_PATTERN.findall(text.casefold())
+
+
+@dataclass
+class _Document:
+    pageid: int
+    ns: int
+    title: str
+    text: str
+    term_counts: Counter
+    length: int
+
+
+class BM25Index:
+    """A local full-text index of page text, ranked with BM25.
+
+    Supports the same `*` and `\\?` wildcards as the wiki's own search, and `Guide:` to only search Guide pages.
+    """
+    K1 = 1.2
+    B = 0.75
+    # Words in a page's title count this many times towards its ranking
+    TITLE_WEIGHT = 3
+    GUIDE_NAMESPACE = 3000
+
+    def __init__(self):
+        self._documents: Dict[str, _Document] = {}
+        # Map each term to the titles of the documents containing it and how many times it appears
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._total_length = 0
+        self._vocabulary: Optional[List[str]] = None
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def rebuild(self, pages: List[Tuple[int, int, str, str]]) -> None:
+        """Replace the contents of the index.
+
+        :param pages: (pageid, ns, title, plain text) tuples for every page."""
+        index = BM25Index()
+        for pageid, ns, title, text in pages:
+            index.update(pageid, ns, title, text)
+        self._documents, self._postings, self._total_length = index._documents, index._postings, index._total_length
+        self._vocabulary = None
+        self.ready = True
+
+    def update(self, pageid: int, ns: int, title: str, text: str) -> None:
+        """Add or replace a page.
+
+        :param pageid: the ID of the page.
+        :param ns: the ID of the page's namespace.
+        :param title: the title of the page.
+        :param text: the plain text of the page."""
+        self.remove(title)
+        term_counts = Counter(tokenise(text))
+        for term in tokenise(title):
+            term_counts[term] += self.TITLE_WEIGHT
+        document = _Document(pageid, ns, title, text, term_counts, sum(term_counts.values()))
+        self._documents[title] = document
+        self._total_length += document.length
+        for term, count in term_counts.items():
+            if term not in self._postings:
+                self._vocabulary = None
+            self._postings.setdefault(term, {})[title] = count
+
+    def remove(self, title: str) -> None:
+        """Remove a page, if it is in the index.
+
+        :param title: the title of the page."""
+        document = self._documents.pop(title, None)
+        if document is None:
+            return
+        self._total_length -= document.length
+        for term in document.term_counts:
+            del self._postings[term][title]
+            if len(self._postings[term]) == 0:
+                del self._postings[term]
+                self._vocabulary = None
+
+    def term_counts(self, titles: Optional[Iterable[str]] = None) -> List[Tuple[str, Counter]]:
+        """Get how many times each term appears in pages, including the extra weight of title terms.
+
+        :param titles: the titles of the pages, or None for every page.
+        :returns: (title, term counts) tuples for each page in the index."""
+        titles = self._documents if titles is None else [title for title in titles if title in self._documents]
+        return [(title, self._documents[title].term_counts) for title in titles]
+
+    def _expand(self, term: str) -> Optional[Set[str]]:
+        """Find every term in the index matching a query term, which may contain wildcards.
+
+        Returns None for wildcard terms that would match too many words to rank quickly."""
+        if "*" not in term and "\\?" not in term:
+            return {term} if term in self._postings else set()
+        # Only terms sharing the text before the first wildcard can match, and those are adjacent when sorted
+        prefix = re.split(r"\*|\\\?", term)[0]
+        if prefix == "":
+            return None
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        pattern = re.compile(re.escape(term).replace(r"\\\?", r"\w").replace(r"\*", r"\w*"))
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        matches = set()
+        for candidate in self._vocabulary[start:]:
+            if not candidate.startswith(prefix):
+                break
+            if pattern.fullmatch(candidate):
+                matches.add(candidate)
+                if len(matches) > MAX_WILDCARD_EXPANSIONS:
+                    return None
+        return matches
+
+    def search(self, query: str, namespaces: List[int],
+               limit: int = 500) -> Optional[Tuple[List[str], Set[str]]]:
+        """Search the index, ranking pages containing every query term with BM25.
+
+        Only the ranking is done here, as building snippets for every result is slow. Pass the titles to `results`
+        as they are needed.
+
+        :param query: the text to search for.
+        :param namespaces: the IDs of the namespaces to search.
+        :param limit: the maximum number of results to return.
+        :returns: a (ranked titles, matched terms) tuple, or None if the query uses syntax that is not supported
+            locally or has a wildcard matching too many words."""
+        if query.casefold().startswith("guide:"):
+            query = query[len("guide:"):]
+            namespaces = [self.GUIDE_NAMESPACE]
+        if _UNSUPPORTED_QUERY_PATTERN.search(query):
+            return None
+        terms = re.findall(r"(?:\w|\*|\\\?)+", query.casefold())
+        if len(terms) == 0:
+            return None
+
+        # Every query term must match, but a wildcard term can match any of its expansions
+        groups = [self._expand(term) for term in terms]
+        if None in groups:
+            return None
+        candidates = None
+        for group in groups:
+            titles = set()
+            for term in group:
+                titles.update(self._postings[term])
+            candidates = titles if candidates is None else candidates & titles
+        candidates = [title for title in candidates if self._documents[title].ns in namespaces]
+
+        matched_terms = set().union(*groups)
+        average_length = self._total_length / len(self._documents) if len(self._documents) > 0 else 0
+        scores = {}
+        for term in matched_terms:
+            postings = self._postings[term]
+            idf = math.log(1 + (len(self._documents) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for title in candidates:
+                count = postings.get(title)
+                if count is None:
+                    continue
+                length_norm = 1 - self.B + self.B * self._documents[title].length / average_length
+                scores[title] = scores.get(title, 0) + idf * count * (self.K1 + 1) / (count + self.K1 * length_norm)
+
+        ranked = sorted(candidates, key=lambda title: scores.get(title, 0), reverse=True)[:limit]
+        return ranked, matched_terms
+
+    def results(self, titles: List[str], matched_terms: Set[str]) -> List[SearchResult]:
+        """Build the search results for pages found by `search`, with snippets of the page around the first match.
+
+        :param titles: the titles of the pages, in the order to return them.
+        :param matched_terms: the terms matched by the search, which are highlighted in the snippets.
+        :returns: a list of SearchResult objects, leaving out pages removed from the index since the search."""
+        return [self._result(self._documents[title], matched_terms) for title in titles if title in self._documents]
+
+    @staticmethod
+    def _result(document: _Document, matched_terms: Set[str]) -> SearchResult:
+        """Build a search result with a snippet of the page around the first match."""
+        text = document.text
+        start = 0
+        for match in _TOKEN_PATTERN.finditer(text):
+            if match.group().casefold() in matched_terms:
+                start = max(0, match.start() - SNIPPET_LENGTH // 3)
+                break
+        # Keep whole words at both ends of the snippet
+        if start > 0:
+            start = text.find(" ", start) + 1
+        end = min(len(text), start + SNIPPET_LENGTH)
+        if end < len(text) and text.rfind(" ", start, end) > start:
+            end = text.rfind(" ", start, end)
+        snippet = _TOKEN_PATTERN.sub(lambda m: f"**{m.group()}**" if m.group().casefold() in matched_terms
+                                     else m.group(), text[start:end])
+        return SearchResult(ns=document.ns, title=document.title, pageid=document.pageid, size=len(text),
+                            wordcount=len(tokenise(text)), snippet=snippet or None)
@@ -1,9 +1,11 @@
+import math
 from typing import List, Union
 
 import discord
 
 from helpers.modals import FeedbackModal
-from helpers.wiki_lib_patch import SearchResult
+from helpers.rate_limiter import WikiUnavailableError
+from helpers.wiki_lib_patch import SearchResult, SearchResultPager
 
 
 class SearchResultsDropdown(discord.ui.Select):
@@ -66,66 +68,91 @@ class PaginationView(BaseView):
 
     @discord.ui.button(emoji="⏪")
     async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # Defer first, as the page may have to be fetched before it can be shown
+        await interaction.response.defer()
         if self.current_page != 0:
             self.current_page = 0
             await self.update()
-        await interaction.response.defer()
 
     @discord.ui.button(emoji="⬅️")
     async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # Defer first, as the page may have to be fetched before it can be shown
+        await interaction.response.defer()
         if self.current_page - 1 >= 0:
             self.current_page = self.current_page - 1
             await self.update()
-        await interaction.response.defer()
 
     @discord.ui.button(emoji="➡️")
     async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # Defer first, as the page may have to be fetched before it can be shown
+        await interaction.response.defer()
         if self.current_page + 1 < len(self.pages):
             self.current_page = self.current_page + 1
             await self.update()
-        await interaction.response.defer()
 
     @discord.ui.button(emoji="⏩")
     async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        # Defer first, as the page may have to be fetched before it can be shown
+        await interaction.response.defer()
         if self.current_page != len(self.pages) - 1:
             self.current_page = len(self.pages) - 1
             await self.update()
-        await interaction.response.defer()
 
 
 class PaginatedSearchView(SearchResultsView, PaginationView):
-    def __init__(self, results: List[SearchResult], *args, **kwargs):
+    def __init__(self, results: SearchResultPager, *args, **kwargs):
         self.RESULTS_PER_PAGE = 5 # NOTE: Can break discord's character limit if set too high
         self.results = results
-        self.result_list = []
+
+        # Pages are formatted as they are shown, as their results may not have been fetched yet
+        pages = [None] * math.ceil(len(results) / self.RESULTS_PER_PAGE)
+        first_page = results.loaded(0, self.RESULTS_PER_PAGE)
+        pages[0] = self.format_page(0, first_page)
+        # The page currently showing, which stays in place if the next one cannot be fetched
+        self.shown_page = 0
+
+        super().__init__([sr.title for sr in first_page], pages, *args, **kwargs)
+
+    def format_page(self, page: int, results: List[SearchResult]) -> str:
+        """Build a page with a header and footer.
+
+        :param page: the index of the page.
+        :param results: the search results on the page.
+        :returns: the text of the page."""
+        result_list = []
         for sr in results:
             section = f"\n-# (section {sr.sectionsnippet})" if sr.sectionsnippet else ""
             snippet = f"{sr.snippet}..." if sr.snippet else "*No snippet available*"
-            self.result_list.append(f"## {sr.title}{section}\n{snippet}")
-        # pages = ["\n\n".join(self.result_list[z:z + 5] if z + 5 <= len(results) else self.result_list[z:len(results)])
-        #          for z in range(0, len(results), 5)]
-
-        # Build paginated pages with header + footer
-        total = len(results)
-        pages = []
-        for i in range(0, total, self.RESULTS_PER_PAGE):
-            start = i + 1
-            end = min(i + self.RESULTS_PER_PAGE, total)
-            header = f"**{total}** results found. Showing **{start}–{end}** of **{total}**\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
-            body = "\n\n".join(self.result_list[i:end])
-            footer = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
-            pages.append(f"{header}\n{body}\n{footer}")
-
-        super().__init__([sr.title for sr in results][:self.RESULTS_PER_PAGE], pages, *args, **kwargs)
+            result_list.append(f"## {sr.title}{section}\n{snippet}")
+
+        total = self.results.total_hits
+        start = page * self.RESULTS_PER_PAGE + 1
+        end = page * self.RESULTS_PER_PAGE + len(results)
+        header = f"**{total}** results found. Showing **{start}–{end}** of **{total}**\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
+        body = "\n\n".join(result_list)
+        footer = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
+        return f"{header}\n{body}\n{footer}"
 
     async def update(self, *args, **kwargs):
         if "view" in kwargs.keys() and kwargs["view"] is None:
             return await super().update(*args, **kwargs)
+        start = self.current_page * self.RESULTS_PER_PAGE
+        try:
+            page_results = await self.results.load(start, start + self.RESULTS_PER_PAGE)
+            # The wiki may have returned fewer results than it first reported
+            self.pages = self.pages[:max(1, math.ceil(len(self.results) / self.RESULTS_PER_PAGE))]
+            if self.current_page >= len(self.pages):
+                self.current_page = len(self.pages) - 1
+                start = self.current_page * self.RESULTS_PER_PAGE
+                page_results = await self.results.load(start, start + self.RESULTS_PER_PAGE)
+        except (WikiUnavailableError, TimeoutError):
+            # Keep showing the current page, so the results can be paged through again once the wiki recovers
+            self.current_page = min(self.shown_page, len(self.pages) - 1)
+            return
+        self.shown_page = self.current_page
+        self.pages[self.current_page] = self.format_page(self.current_page, page_results)
         self.remove_item(self.dropdown)
-        # TODO: This is really cursed, maybe expand into a for loop?
-        self.dropdown = SearchResultsDropdown(
-            [result.title for result in (self.results[self.current_page*self.RESULTS_PER_PAGE:(self.current_page*self.RESULTS_PER_PAGE + self.RESULTS_PER_PAGE if
-             self.current_page*self.RESULTS_PER_PAGE + self.RESULTS_PER_PAGE < len(self.results) else len(self.results))])])
+        self.dropdown = SearchResultsDropdown([result.title for result in page_results])
         self.add_item(self.dropdown)
         await super().update(view=self, *args, **kwargs)
 
@@ -0,0 +1,417 @@
+import asyncio
+import json
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from helpers.caches import ResponseCache
+from helpers.rate_limiter import RateLimiter, RetryableError, WikiUnavailableError
+from helpers.wiki_lib_patch import SearchResult
+
+# aiohttp decodes brotli responses when either brotli package is installed, so only ask for them then
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+
+class WikiError(Exception):
+    """Raised when the wiki API returns an error response."""
+
+
+class PageError(WikiError):
+    """Raised when a requested page does not exist on the wiki."""
+    def __init__(self, title: str):
+        super().__init__(f"\"{title}\" does not match any pages.")
+        self.title = title
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds, ignoring the rarely used HTTP date form."""
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class WikiPage:
+    """The information needed to link to a wiki page."""
+    title: str
+    pageid: int
+    url: str
+    fragment: Optional[str] = None
+
+    @property
+    def link(self) -> str:
+        """The URL of the page, including the section it was redirected to, if any."""
+        return f"{self.url}#{self.fragment.replace(' ', '_')}" if self.fragment else self.url
+
+
+@dataclass(frozen=True)
+class PageSummary:
+    """The introduction and thumbnail of a page, for embedding a preview of it."""
+    title: str
+    url: str
+    extract: Optional[str] = None
+    thumbnail: Optional[str] = None
+
+
+class AsyncMediaWiki:
+    """A minimal MediaWiki API client built on aiohttp.
+
+    All requests share one pooled, keep-alive session so that wiki lookups never block the event loop.
+    """
+    MAX_TITLES_PER_REQUEST = 50
+    MAX_EXTRACTS_PER_REQUEST = 20
+
+    # Ask the wiki to refuse requests while its database replicas lag by more than this many seconds
+    MAX_LAG = 5
+
+    def __init__(self, api_url: str, user_agent: str, timeout: float = 10, pool_size: int = 10,
+                 limiter: Optional[RateLimiter] = None, response_cache: Optional[ResponseCache] = None):
+        """Initialise the client.
+
+        The HTTP session is created lazily, as it must be created inside a running event loop.
+
+        :param api_url: the URL of the wiki's api.php.
+        :param user_agent: the User-Agent header to send with every request.
+        :param timeout: the total timeout for a single attempt at a request, in seconds.
+        :param pool_size: the maximum number of simultaneous connections to the wiki.
+        :param limiter: the limits every request is made within, or None for the default limits.
+        :param response_cache: the cache responses are revalidated against, or None for the default cache.
+        """
+        self.api_url = api_url
+        self.user_agent = user_agent
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared HTTP session, created on first use."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout,
+                                                  headers={"User-Agent": self.user_agent,
+                                                           "Accept-Encoding": ACCEPT_ENCODING})
+        return self._session
+
+    async def close(self) -> None:
+        """Close the HTTP session and release its connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def wiki_request(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Make a request to the wiki API.
+
+        Requests are made within the limiter's limits, and retried when the wiki is overloaded or lagging.
+
+        :param params: the API parameters; `action` defaults to `query`.
+        :returns: the decoded JSON response.
+        :raises WikiError: if the API returns an error.
+        :raises WikiUnavailableError: if the wiki kept failing, or has been failing and requests are not being made.
+        :raises TimeoutError: if the request could not be completed in time."""
+        request_params = {"action": "query", "format": "json", "formatversion": 2, "maxlag": self.MAX_LAG}
+        request_params.update(params)
+        return await self.limiter.run(lambda: self._request(request_params))
+
+    async def _request(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Make a single attempt at a request to the wiki API.
+
+        Responses the wiki sent validators for are revalidated, so unchanged responses are not downloaded again."""
+        key = self.response_cache.key(params)
+        try:
+            async with self.session.get(self.api_url, params=params,
+                                        headers=self.response_cache.conditional_headers(key)) as response:
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableError(f"The wiki responded with HTTP {response.status}", retry_after)
+                if response.status == 304:
+                    body = self.response_cache.not_modified(key)
+                    if body is None:
+                        raise RetryableError("The wiki's response was evicted from the cache before it was reused")
+                    return json.loads(body)
+                response.raise_for_status()
+                body = await response.read()
+                # Content-Length is the size before decompression, when the wiki sends it
+                self.response_cache.record_transfer(response.content_length, len(body))
+                headers = response.headers
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise RetryableError(f"Could not reach the wiki: {e!r}")
+        except aiohttp.ClientResponseError as e:
+            raise WikiUnavailableError(f"The wiki responded with HTTP {e.status}")
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            # Such as an HTML error page from a proxy in front of the wiki
+            raise WikiUnavailableError("The wiki's response was not JSON")
+        if "error" in data:
+            if data["error"].get("code") == "maxlag":
+                raise RetryableError("The wiki's database is lagging", retry_after or self.MAX_LAG)
+            raise WikiError(data["error"].get("info", "Unknown wiki API error"))
+        self.response_cache.store(key, body, headers)
+        return data
+
+    async def query_continue(self, params: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """Make a query request, following continuations until every result has been fetched.
+
+        :param params: the API parameters.
+        :returns: an async iterator over the `query` part of each response."""
+        continuation = {}
+        while True:
+            data = await self.wiki_request({**params, **continuation})
+            if "query" in data:
+                yield data["query"]
+            if "continue" not in data:
+                return
+            continuation = data["continue"]
+
+    async def all_pages(self, namespace: int, redirects: bool = False) -> AsyncIterator[Dict[str, Any]]:
+        """List every page in a namespace.
+
+        :param namespace: the ID of the namespace to list.
+        :param redirects: when enabled, list only redirects instead of only pages that are not redirects.
+        :returns: an async iterator over each page's `pageid`, `ns` and `title`."""
+        async for query in self.query_continue({
+            "list": "allpages",
+            "apnamespace": namespace,
+            "apfilterredir": "redirects" if redirects else "nonredirects",
+            "aplimit": "max"
+        }):
+            for page in query["allpages"]:
+                yield page
+
+    async def all_redirects(self, namespace: int) -> AsyncIterator[Tuple[int, str, Optional[str]]]:
+        """List every redirect that points into a namespace.
+
+        :param namespace: the ID of the namespace the redirects point into.
+        :returns: an async iterator over (redirect page ID, target title, target fragment) tuples."""
+        async for query in self.query_continue({
+            "list": "allredirects",
+            "arnamespace": namespace,
+            "arprop": "ids|title|fragment",
+            "arlimit": "max"
+        }):
+            for redirect in query["allredirects"]:
+                yield redirect["fromid"], redirect["title"], redirect.get("fragment") or None
+
+    async def page_texts(self, namespace: Optional[int] = None,
+                         titles: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Fetch the current wikitext of many pages, 50 pages per request.
+
+        Either every page in a namespace or a list of titles is fetched. Redirects are not followed, so a
+        redirect is returned with its own wikitext.
+
+        :param namespace: the ID of the namespace to fetch every non-redirect page from.
+        :param titles: the titles of the pages to fetch.
+        :returns: an async iterator over each page's `pageid`, `ns`, `title`, `text`, `timestamp` and
+            `redirect`, or `title` and `missing` for titles that do not exist."""
+        params = {"prop": "revisions|info", "rvprop": "content|timestamp", "rvslots": "main"}
+        if titles is None:
+            batches = [{"generator": "allpages", "gapnamespace": namespace, "gapfilterredir": "nonredirects",
+                        "gaplimit": self.MAX_TITLES_PER_REQUEST}]
+        else:
+            unique_titles = list(dict.fromkeys(titles))
+            batches = [{"titles": "|".join(unique_titles[i:i + self.MAX_TITLES_PER_REQUEST])}
+                       for i in range(0, len(unique_titles), self.MAX_TITLES_PER_REQUEST)]
+        for batch in batches:
+            async for query in self.query_continue({**params, **batch}):
+                for page in query.get("pages", []):
+                    if page.get("missing") or page.get("invalid"):
+                        yield {"title": page["title"], "missing": True}
+                    # Pages without revisions have their content sent in a later continuation
+                    elif "revisions" in page:
+                        revision = page["revisions"][0]
+                        yield {"pageid": page["pageid"], "ns": page["ns"], "title": page["title"],
+                               "text": revision["slots"]["main"]["content"], "timestamp": revision["timestamp"],
+                               "redirect": page.get("redirect", False)}
+
+    async def recent_changes(self, start: str, namespaces: List[int]) -> AsyncIterator[Dict[str, Any]]:
+        """List every edit, page creation and log entry since a point in time, oldest first.
+
+        :param start: the ISO 8601 timestamp to list changes from, inclusive.
+        :param namespaces: the IDs of the namespaces to list changes in.
+        :returns: an async iterator over each change's `rcid`, `type`, `title`, `timestamp` and, for log
+            entries, `logtype` and `logparams`."""
+        async for query in self.query_continue({
+            "list": "recentchanges",
+            "rcstart": start,
+            "rcdir": "newer",
+            "rcnamespace": "|".join(map(str, namespaces)),
+            "rcprop": "ids|title|timestamp|loginfo",
+            "rctype": "edit|new|log",
+            "rclimit": "max"
+        }):
+            for change in query["recentchanges"]:
+                yield change
+
+    async def search(self, query: str, results: int = 10) -> List[str]:
+        """Search the wiki for page titles.
+
+        :param query: the text to search for.
+        :param results: the maximum number of results to return.
+        :returns: a list of page titles."""
+        data = await self.wiki_request({
+            "list": "search",
+            "srprop": "",
+            "srlimit": results,
+            "srsearch": query
+        })
+        return [result["title"] for result in data["query"]["search"]]
+
+    async def page(self, title: str) -> WikiPage:
+        """Fetch a page, following redirects.
+
+        :param title: the title of the page.
+        :returns: the page requested.
+        :raises PageError: if the page does not exist."""
+        page = (await self.pages([title]))[title]
+        if page is None:
+            raise PageError(title)
+        return page
+
+    @staticmethod
+    def _resolve_titles(titles: List[str], query: Dict[str, Any]) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Find the title each requested title ended up as, after the API normalised, converted and redirected it.
+
+        :param titles: the titles that were requested.
+        :param query: the `query` part of the response.
+        :returns: a dict mapping each requested title to a (resolved title, redirect fragment) tuple."""
+        # Each of these maps a title to the title the API replaced it with
+        renames = {}
+        for key in ("normalized", "converted"):
+            renames.update({entry["from"]: entry["to"] for entry in query.get(key, [])})
+        redirects = {entry["from"]: entry for entry in query.get("redirects", [])}
+        results = {}
+        for title in titles:
+            resolved = title
+            seen = {title}
+            # A title can be normalised before being converted, so follow renames until they stop
+            while resolved in renames and renames[resolved] not in seen:
+                resolved = renames[resolved]
+                seen.add(resolved)
+            fragment = None
+            if resolved in redirects:
+                fragment = redirects[resolved].get("tofragment")
+                resolved = redirects[resolved]["to"]
+            results[title] = (resolved, fragment)
+        return results
+
+    async def pages(self, titles: List[str]) -> Dict[str, Optional[WikiPage]]:
+        """Fetch many pages at once, following redirects and title conversions.
+
+        Titles are sent in batches of up to 50, the API's limit, so most messages need a single request.
+
+        :param titles: the titles of the pages.
+        :returns: a dict mapping each requested title to its page, or None if it does not exist."""
+        results: Dict[str, Optional[WikiPage]] = {}
+        unique_titles = list(dict.fromkeys(titles))
+        for i in range(0, len(unique_titles), self.MAX_TITLES_PER_REQUEST):
+            batch = unique_titles[i:i + self.MAX_TITLES_PER_REQUEST]
+            data = await self.wiki_request({
+                "prop": "info",
+                "inprop": "url",
+                "redirects": 1,
+                "converttitles": 1,
+                "titles": "|".join(batch)
+            })
+            query = data.get("query", {})
+            found = {page["title"]: page for page in query.get("pages", [])
+                     if not page.get("missing") and not page.get("invalid")}
+            for title, (resolved, fragment) in self._resolve_titles(batch, query).items():
+                page = found.get(resolved)
+                results[title] = None if page is None else WikiPage(page["title"], page["pageid"], page["fullurl"],
+                                                                    fragment)
+        return results
+
+    async def page_summaries(self, titles: List[str], extract_length: int = 300,
+                             thumbnail_size: int = 256) -> Dict[str, Optional[PageSummary]]:
+        """Fetch the introduction and thumbnail of many pages at once, following redirects.
+
+        Titles are sent in batches of up to 20, the most extracts the API returns per request.
+
+        :param titles: the titles of the pages.
+        :param extract_length: the maximum number of characters of each introduction.
+        :param thumbnail_size: the width of each thumbnail, in pixels.
+        :returns: a dict mapping each requested title to its summary, or None if it does not exist."""
+        results: Dict[str, Optional[PageSummary]] = {}
+        unique_titles = list(dict.fromkeys(titles))
+        for i in range(0, len(unique_titles), self.MAX_EXTRACTS_PER_REQUEST):
+            batch = unique_titles[i:i + self.MAX_EXTRACTS_PER_REQUEST]
+            data = await self.wiki_request({
+                "prop": "extracts|pageimages|info",
+                "exintro": 1,
+                "explaintext": 1,
+                "exchars": extract_length,
+                "exlimit": self.MAX_EXTRACTS_PER_REQUEST,
+                "piprop": "thumbnail",
+                "pithumbsize": thumbnail_size,
+                "inprop": "url",
+                "redirects": 1,
+                "converttitles": 1,
+                "titles": "|".join(batch)
+            })
+            query = data.get("query", {})
+            found = {page["title"]: page for page in query.get("pages", [])
+                     if not page.get("missing") and not page.get("invalid")}
+            for title, (resolved, _) in self._resolve_titles(batch, query).items():
+                page = found.get(resolved)
+                results[title] = None if page is None else PageSummary(
+                    page["title"], page["fullurl"], page.get("extract") or None,
+                    page.get("thumbnail", {}).get("source"))
+        return results
+
+    async def sections(self, title: str) -> List[str]:
+        """Fetch the section headings of a page.
+
+        :param title: the title of the page.
+        :returns: a list of section headings, in page order.
+        :raises PageError: if the page does not exist."""
+        try:
+            data = await self.wiki_request({
+                "action": "parse",
+                "page": title,
+                "prop": "sections",
+                "redirects": 1
+            })
+        except WikiError:
+            raise PageError(title)
+        return [section["line"] for section in data["parse"]["sections"]]
+
+    async def advanced_search(self, query: str, srprop: Optional[List[str]] = None,
+                              srnamespace: Optional[List[int]] = None, limit: Optional[int] = None,
+                              offset: int = 0) -> Tuple[List[SearchResult], int]:
+        """Search text in pages with srprop and srnamespace.
+
+        :param query: the text to search for.
+        :param srprop: list of srprop included in the response.
+        :param srnamespace: list of namespace IDs to search, passing None searches all namespaces.
+        :param limit: number of pages to return, None means no limit and will attempt to fetch 500.
+        :param offset: the number of results to skip, for fetching later pages of results.
+        :returns: a list of SearchResult instances, and the total number of pages matching the query."""
+        if not query:
+            raise ValueError("Query must be specified")
+
+        max_pull = 500
+
+        data = await self.wiki_request({
+            "list": "search",
+            "srnamespace": "|".join(map(str, srnamespace)) if srnamespace else "*",
+            "srprop": "|".join(srprop) if srprop else "",
+            "srinfo": "totalhits",
+            "srlimit": min(limit, max_pull) if limit is not None else max_pull,
+            "srsearch": query,
+            "sroffset": offset
+        })
+
+        results = [SearchResult.model_validate(d) for d in data["query"]["search"]]
+        return results, data["query"].get("searchinfo", {}).get("totalhits", offset + len(results))
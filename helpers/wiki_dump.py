@@ -0,0 +1,60 @@
+import pathlib
+import re
+import xml.etree.ElementTree as ElementTree
+from dataclasses import dataclass
+from typing import Iterator, Optional, Union
+
+_REDIRECT_PATTERN = re.compile(r"^\s*#REDIRECT\s*:?\s*\[\[([^\]|#]*)(?:#([^\]|]*))?", re.IGNORECASE)
+
+
+@dataclass
+class DumpPage:
+    """The latest revision of a page from an XML dump."""
+    pageid: int
+    ns: int
+    title: str
+    text: str
+    timestamp: str
+    redirect: Optional[str] = None
+    redirect_fragment: Optional[str] = None
+
+
+def _tag(element: ElementTree.Element) -> str:
+    """Get the tag of an element without its XML namespace, which changes between export versions."""
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def iter_dump_pages(path: Union[str, pathlib.Path]) -> Iterator[DumpPage]:
+    """Stream the pages in a MediaWiki XML dump, such as one from Special:Export or dumpgenerator.
+
+    Each page is cleared from memory once it has been read, so memory use does not grow with the size of the dump.
+
+    :param path: the path to the dump.
+    :returns: an iterator over the latest revision of each page."""
+    root = None
+    for event, element in ElementTree.iterparse(path, events=("start", "end")):
+        if root is None:
+            root = element
+        if event != "end" or _tag(element) != "page":
+            continue
+        fields = {_tag(child): child for child in element}
+        latest = None
+        for child in element:
+            if _tag(child) != "revision":
+                continue
+            revision = {_tag(field): field for field in child}
+            timestamp = revision["timestamp"].text if "timestamp" in revision else ""
+            if latest is None or timestamp >= latest[0]:
+                latest = (timestamp, (revision["text"].text or "") if "text" in revision else "")
+        if latest is not None:
+            timestamp, text = latest
+            redirect = fields["redirect"].get("title") if "redirect" in fields else None
+            fragment = None
+            match = _REDIRECT_PATTERN.match(text)
+            if redirect is not None and match is not None:
+                fragment = match.group(2) or None
+            yield DumpPage(int(fields["id"].text), int(fields["ns"].text), fields["title"].text, text, timestamp,
+                           redirect, fragment)
+        element.clear()
+        # Drop the cleared page from the root too, or the empty elements would pile up
+        root.clear()
@@ -0,0 +1,374 @@
+import bisect
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+def normalise_title(text: str) -> str:
+    """Normalise a title or query into an index key.
+
+    Underscores and runs of whitespace collapse to single spaces and the result is case-folded,
+    so `[[ap_ upgrades]]` and `[[AP Upgrades]]` share a key.
+
+    :param text: the title or query to normalise.
+    :returns: the index key."""
+    return " ".join(text.replace("_", " ").split()).casefold()
+
+
+def _exact_title(text: str) -> str:
+    """Normalise a title the way MediaWiki does, keeping its case apart from the first letter."""
+    text = " ".join(text.replace("_", " ").split())
+    return text[:1].upper() + text[1:]
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Count the insertions, deletions, substitutions and adjacent transpositions needed to turn one string into
+    another.
+
+    :param a: the first string.
+    :param b: the second string.
+    :param max_distance: stop counting once the distance is known to be over this.
+    :returns: the distance, or `max_distance + 1` if it is over `max_distance`."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class FuzzyMatcher:
+    """Finds the keys closest to some text by edit distance, for typo-tolerant lookups.
+
+    This is a SymSpell-style deletion dictionary: every key is stored under each string that can be made by
+    deleting up to `max_distance` characters from its prefix, so only keys sharing one of the text's deletions
+    need their full edit distance checked.
+    """
+    def __init__(self, max_distance: int = 2, prefix_length: int = 7):
+        """Initialise the matcher.
+
+        :param max_distance: the largest edit distance a match can have.
+        :param prefix_length: the number of leading characters deletions are made from, trading memory for the
+            number of candidates checked.
+        """
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self._deletions: Dict[str, Set[str]] = {}
+
+    def _deletes(self, key: str) -> Set[str]:
+        """Find every string made by deleting up to `max_distance` characters from the prefix of a key."""
+        deletes = {key[:self.prefix_length]}
+        edge = set(deletes)
+        for _ in range(self.max_distance):
+            edge = {word[:i] + word[i + 1:] for word in edge for i in range(len(word))}
+            deletes.update(edge)
+        return deletes
+
+    def add(self, key: str) -> None:
+        """Add a key.
+
+        :param key: the normalised key to add."""
+        for delete in self._deletes(key):
+            self._deletions.setdefault(delete, set()).add(key)
+
+    def remove(self, key: str) -> None:
+        """Remove a key, if it has been added.
+
+        :param key: the normalised key to remove."""
+        for delete in self._deletes(key):
+            keys = self._deletions.get(delete)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._deletions[delete]
+
+    def match(self, text: str) -> Tuple[List[str], float]:
+        """Find the keys closest to some text.
+
+        :param text: the normalised text to match.
+        :returns: every key at the smallest edit distance, and the confidence of the match from 0 to 1,
+            which falls as the distance grows relative to the length of the text."""
+        candidates = set()
+        for delete in self._deletes(text):
+            candidates.update(self._deletions.get(delete, ()))
+        best, best_distance = [], self.max_distance + 1
+        for candidate in candidates:
+            distance = edit_distance(text, candidate, min(best_distance, self.max_distance))
+            if distance < best_distance:
+                best, best_distance = [candidate], distance
+            elif distance == best_distance and distance <= self.max_distance:
+                best.append(candidate)
+        if len(best) == 0:
+            return [], 0.0
+        return sorted(best), 1 - best_distance / max(len(text), len(best[0]))
+
+
+class TitleIndex:
+    """An in-memory index of every page title and redirect on the wiki.
+
+    Lookups try the exact title first, so pages whose titles only differ by case still resolve correctly,
+    before falling back to the case-folded key.
+    """
+    def __init__(self):
+        # Both map a key to the (canonical title, fragment) it resolves to
+        self._exact: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._folded: Dict[str, Tuple[str, Optional[str]]] = {}
+        self._titles: Dict[str, str] = {}
+        # Finds the case-folded keys closest to a query with a typo in it
+        self._fuzzy = FuzzyMatcher()
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    def __contains__(self, text: str) -> bool:
+        return self.resolve(text) is not None
+
+    @property
+    def titles(self) -> List[str]:
+        """Every canonical page title in the index, excluding redirects."""
+        return list(self._titles.values())
+
+    def rebuild(self, titles: Iterable[str], redirects: Iterable[Tuple[str, str, Optional[str]]]) -> None:
+        """Replace the contents of the index.
+
+        The new index is built separately and swapped in, so lookups never see a partially built index.
+
+        :param titles: the titles of every page that is not a redirect.
+        :param redirects: (source, target, fragment) tuples for every redirect."""
+        index = TitleIndex()
+        for title in titles:
+            index.add_page(title)
+        for source, target, fragment in redirects:
+            index.add_redirect(source, target, fragment)
+        self._exact, self._folded, self._titles = index._exact, index._folded, index._titles
+        self._fuzzy = index._fuzzy
+        self.ready = True
+
+    def add_page(self, title: str) -> None:
+        """Add a page, replacing any redirect with the same title.
+
+        :param title: the canonical title of the page."""
+        self._titles[_exact_title(title)] = title
+        self._exact[_exact_title(title)] = (title, None)
+        self._folded[normalise_title(title)] = (title, None)
+        self._fuzzy.add(normalise_title(title))
+
+    def add_redirect(self, source: str, target: str, fragment: Optional[str] = None) -> None:
+        """Add a redirect, replacing any page with the same title.
+
+        :param source: the title of the redirect.
+        :param target: the title the redirect points to.
+        :param fragment: the section the redirect points to, if any."""
+        self._titles.pop(_exact_title(source), None)
+        self._exact[_exact_title(source)] = (target, fragment)
+        folded = normalise_title(source)
+        # Never let a redirect shadow a real page that only differs by case
+        if folded not in self._folded or self._folded[folded][1] is not None or self._folded[folded][0] == source:
+            self._folded[folded] = (target, fragment)
+        self._fuzzy.add(folded)
+
+    def remove(self, title: str) -> None:
+        """Remove a page or redirect from the index.
+
+        :param title: the title to remove."""
+        self._titles.pop(_exact_title(title), None)
+        removed = self._exact.pop(_exact_title(title), None)
+        folded = normalise_title(title)
+        if removed is not None and self._folded.get(folded) == removed:
+            del self._folded[folded]
+            # Another title may share the same case-folded key
+            for exact, entry in self._exact.items():
+                if normalise_title(exact) == folded:
+                    self._folded[folded] = entry
+                    break
+            else:
+                self._fuzzy.remove(folded)
+
+    def resolve(self, text: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Resolve text to the page it refers to, following a single redirect.
+
+        :param text: the title or query to resolve.
+        :returns: a (canonical title, fragment) tuple, or None if no page matches."""
+        entry = self._exact.get(_exact_title(text)) or self._folded.get(normalise_title(text))
+        if entry is None:
+            return None
+        title, fragment = entry
+        # Broken redirects point at pages which do not exist
+        if _exact_title(title) not in self._titles:
+            return None
+        return self._titles[_exact_title(title)], fragment
+
+    def entries(self) -> Iterator[Tuple[str, str, Optional[str]]]:
+        """List every case-folded key in the index and the page it resolves to, skipping broken redirects.
+
+        :returns: an iterator over (normalised key, canonical title, fragment) tuples."""
+        for key in list(self._folded):
+            entry = self.resolve(key)
+            if entry is not None:
+                yield key, entry[0], entry[1]
+
+    def fuzzy_resolve(self, text: str) -> Optional[Tuple[str, Optional[str], float]]:
+        """Resolve text that may contain a typo to the page it most likely refers to.
+
+        :param text: the title or query to resolve.
+        :returns: a (canonical title, fragment, confidence) tuple, where confidence is from 0 to 1, or None if
+            no page is close enough or the closest titles refer to different pages."""
+        keys, confidence = self._fuzzy.match(normalise_title(text))
+        entries = {self.resolve(key) for key in keys}
+        if len(entries) != 1 or None in entries:
+            return None
+        title, fragment = entries.pop()
+        return title, fragment, confidence
+
+
+_HEADING_PATTERN = re.compile(r"^(={1,6})[ \t]*(.+?)[ \t]*\1[ \t]*$", re.MULTILINE)
+_COMMENT_PATTERN = re.compile(r"<!--.*?-->", re.DOTALL)
+_TEMPLATE_PATTERN = re.compile(r"\{\{[^{}]*\}\}")
+_LINK_PATTERN = re.compile(r"\[\[(?:[^|\]]*\|)?([^\]]*)\]\]")
+_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+def parse_headings(wikitext: str) -> List[str]:
+    """Find the section headings of a page from its wikitext.
+
+    Headings generated by templates are not found, as that would require rendering the page.
+
+    :param wikitext: the wikitext of the page.
+    :returns: the plain text of each heading, in page order."""
+    wikitext = _COMMENT_PATTERN.sub("", wikitext)
+    headings = []
+    for match in _HEADING_PATTERN.finditer(wikitext):
+        heading = _TEMPLATE_PATTERN.sub("", match.group(2))
+        heading = _LINK_PATTERN.sub(r"\1", heading)
+        heading = _TAG_PATTERN.sub("", heading).replace("'''", "").replace("''", "")
+        heading = " ".join(heading.split())
+        if heading:
+            headings.append(heading)
+    return headings
+
+
+def section_anchors(headings: List[str]) -> List[str]:
+    """Convert section headings to the anchors MediaWiki gives them.
+
+    Repeated headings get `_2`, `_3`, etc. appended, like they do on the wiki.
+
+    :param headings: the headings of a page, in page order.
+    :returns: the anchor of each heading."""
+    anchors = []
+    seen = set()
+    for heading in headings:
+        anchor = heading.replace(" ", "_")
+        candidate, count = anchor, 1
+        while candidate in seen:
+            count += 1
+            candidate = f"{anchor}_{count}"
+        seen.add(candidate)
+        anchors.append(candidate)
+    return anchors
+
+
+class SectionIndex:
+    """An in-memory index of the section headings of every page on the wiki."""
+    def __init__(self):
+        # Maps the exact title of a page to its (heading, anchor) pairs
+        self._pages: Dict[str, Tuple[str, List[Tuple[str, str]]]] = {}
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+    def rebuild(self, pages: Iterable[Tuple[str, List[str]]]) -> None:
+        """Replace the contents of the index.
+
+        :param pages: (title, headings) tuples for every page."""
+        index = SectionIndex()
+        for title, headings in pages:
+            index.update(title, headings)
+        self._pages = index._pages
+        self.ready = True
+
+    def update(self, title: str, headings: List[str]) -> None:
+        """Add or replace the sections of a page.
+
+        :param title: the canonical title of the page.
+        :param headings: the headings of the page, in page order."""
+        self._pages[_exact_title(title)] = (title, list(zip(headings, section_anchors(headings))))
+
+    def remove(self, title: str) -> None:
+        """Remove a page from the index.
+
+        :param title: the title of the page."""
+        self._pages.pop(_exact_title(title), None)
+
+    def entries(self) -> Iterable[Tuple[str, str, str]]:
+        """Iterate over every section in the index.
+
+        :returns: an iterator over (title, heading, anchor) tuples."""
+        for canonical, sections in self._pages.values():
+            for heading, anchor in sections:
+                yield canonical, heading, anchor
+
+    def find(self, title: str, text: str) -> List[str]:
+        """Find the sections of a page whose headings contain text.
+
+        :param title: the title of the page to search.
+        :param text: the text to search for, ignoring case.
+        :returns: a list of result strings in the format `Page#Section`."""
+        if _exact_title(title) not in self._pages:
+            return []
+        canonical, sections = self._pages[_exact_title(title)]
+        text = text.casefold()
+        return [f"{canonical}#{anchor}" for heading, anchor in sections if text in heading.casefold()]
+
+
+class PrefixIndex:
+    """A sorted array of normalised keys for answering prefix lookups with a binary search."""
+    def __init__(self):
+        self._keys: List[str] = []
+        self._values: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def rebuild(self, titles: Iterable[str], sections: Iterable[Tuple[str, str, str]]) -> None:
+        """Replace the contents of the index.
+
+        Sections can be found by their heading alone, as well as by `Page#Section`.
+
+        :param titles: the titles of every page.
+        :param sections: (title, heading, anchor) tuples for every section."""
+        entries = {(normalise_title(title), title) for title in titles}
+        for title, heading, anchor in sections:
+            value = f"{title}#{anchor}"
+            entries.add((normalise_title(f"{title}#{heading}"), value))
+            entries.add((normalise_title(heading), value))
+        entries = sorted(entries)
+        self._keys, self._values = [key for key, _ in entries], [value for _, value in entries]
+
+    def complete(self, text: str, limit: int = 25) -> List[str]:
+        """Find the entries starting with some text.
+
+        Pages are listed before sections, then shorter entries before longer ones.
+
+        :param text: the text the entries should start with.
+        :param limit: the maximum number of entries to return.
+        :returns: the matching titles and `Page#Section` anchors."""
+        prefix = normalise_title(text)
+        keys, values = self._keys, self._values
+        matches = []
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            # Short prefixes match most of the wiki, and only the first few matches can be shown anyway
+            if not keys[i].startswith(prefix) or len(matches) >= limit * 40:
+                break
+            matches.append(values[i])
+        matches = sorted(dict.fromkeys(matches), key=lambda value: ("#" in value, len(value)))
+        return matches[:limit]
@@ -0,0 +1,122 @@
+import mmap
+import os
+import pathlib
+import struct
+from typing import Iterable, Optional, Tuple
+
+from helpers.wiki_index import normalise_title
+
+MAGIC = b"WTIX"
+FORMAT_VERSION = 2
+
+# Magic, format version, number of entries, length of the string table
+_HEADER = struct.Struct("<4sIII")
+# Offset and length of the key, title and fragment in the string table
+_ENTRY = struct.Struct("<IIIIII")
+
+
+def write_title_index(path: pathlib.Path, entries: Iterable[Tuple[str, str, Optional[str]]]) -> None:
+    """Write a title index file, replacing any existing file atomically.
+
+    The file is a header, then a table of fixed-size entries sorted by key, then a table of the strings they
+    point to. Readers can binary-search the entries without loading the file.
+
+    :param path: the path of the file.
+    :param entries: (normalised key, canonical title, fragment) tuples for every key to look up."""
+    strings = bytearray()
+    offsets = {}
+
+    def add_string(text: Optional[str]) -> Tuple[int, int]:
+        if not text:
+            return 0, 0
+        encoded = text.encode("utf-8")
+        # Redirects often share their target's title, so each string is only stored once
+        if encoded not in offsets:
+            offsets[encoded] = len(strings)
+            strings.extend(encoded)
+        return offsets[encoded], len(encoded)
+
+    # Keys are compared as UTF-8 bytes when searching, so they are sorted the same way
+    records = sorted(entries, key=lambda entry: entry[0].encode("utf-8"))
+    table = bytearray()
+    for key, title, fragment in records:
+        table.extend(_ENTRY.pack(*add_string(key), *add_string(title), *add_string(fragment)))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    with temporary_path.open("wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(records), len(strings)))
+        f.write(table)
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    # Readers either see the old file or the new one, never a partly written one
+    os.replace(temporary_path, path)
+
+
+class MappedTitleIndex:
+    """A title index file written by `write_title_index`, memory-mapped rather than loaded.
+
+    Opening it takes the same time however many titles there are, and the operating system shares its pages
+    between every process that maps it.
+    """
+    def __init__(self, path: pathlib.Path):
+        """Open the file.
+
+        :param path: the path of the file.
+        :raises ValueError: if the file is not a title index, was written in a different format version, or is
+            truncated.
+        :raises OSError: if the file could not be opened."""
+        with path.open("rb") as f:
+            # The mapping stays valid after the file is closed, or replaced by a newer index
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self._count, strings_length = _HEADER.unpack_from(self._map, 0)
+        except struct.error:
+            self._map.close()
+            raise ValueError(f"{path} is too short to be a title index")
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} title index")
+        self._strings_start = _HEADER.size + self._count * _ENTRY.size
+        # A file cut off part way through would otherwise fail on every lookup
+        size = len(self._map)
+        if size != self._strings_start + strings_length:
+            self._map.close()
+            raise ValueError(f"{path} is {size} bytes long, but its header describes "
+                             f"{self._strings_start + strings_length} bytes")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self) -> None:
+        """Unmap the file."""
+        self._map.close()
+
+    def _entry(self, position: int) -> Tuple[int, int, int, int, int, int]:
+        return _ENTRY.unpack_from(self._map, _HEADER.size + position * _ENTRY.size)
+
+    def _string(self, offset: int, length: int) -> bytes:
+        start = self._strings_start + offset
+        return self._map[start:start + length]
+
+    def resolve(self, text: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Resolve text to the page it refers to.
+
+        :param text: the title or query to resolve.
+        :returns: a (canonical title, fragment) tuple, or None if no page matches."""
+        key = normalise_title(text).encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._string(*self._entry(middle)[:2]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._count:
+            return None
+        key_offset, key_length, title_offset, title_length, fragment_offset, fragment_length = self._entry(low)
+        if self._string(key_offset, key_length) != key:
+            return None
+        fragment = self._string(fragment_offset, fragment_length).decode("utf-8") if fragment_length else None
+        return self._string(title_offset, title_length).decode("utf-8"), fragment
@@ -1,6 +1,5 @@
-from mediawiki import MediaWiki
-from mediawiki.utilities import memoize
-from typing import List, Optional
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
 from pydantic import BaseModel, field_validator
 import re
 import html
@@ -33,49 +32,81 @@ class SearchResult(BaseModel):
         v = html.unescape(v)
         return v
 
+    def to_tuple(self) -> tuple:
+        """Convert the result to a plain tuple, which takes much less memory to cache than the model."""
+        return tuple(getattr(self, field) for field in type(self).model_fields)
 
-class PatchedMediaWiki(MediaWiki):
-    @memoize
-    def advanced_search(
-        self, query: str, srprop: Optional[List[str]] = None, srnamespace: Optional[List[int]] = None, limit: Optional[int] = None
-    ) -> List[SearchResult]:
-        """Search text in pages with srprop and srnamespace
+    @classmethod
+    def from_tuple(cls, values: tuple) -> "SearchResult":
+        """Convert a tuple made by `to_tuple` back to a result, without cleaning the snippets again."""
+        return cls.model_construct(**dict(zip(cls.model_fields, values)))
 
-        Args:
-            query (str): Page title
-            limit (Optional[int]): Number of pages to return, set to None means no limit and will attempt to fetch 500
-            srprop (Optional[List[str]]): List of srprop included in the response
-            srnamespace(Optional[List[int]]): List of namespace ids used for searching, passing None searches all namespaces
-        Returns:
-            list of SearchResult instances
-            class SearchResult(BaseModel):
-                ns: int
-                title: str
-                pageid: int
-                size: Optional[int] = None
-                wordcount: Optional[int] = None
-                snippet: Optional[str] = None
-                sectionsnippet: Optional[str] = None
-                timestamp: Optional[str] = None        
+
+class SearchResultPager:
+    """Search results which are fetched a chunk at a time, as they are paged through."""
+    def __init__(self, fetch: Callable[[int, int], Awaitable[Tuple[List[SearchResult], int]]],
+                 chunk_size: int = 10, max_results: int = 500):
+        """Initialise the pager.
+
+        :param fetch: fetches (results, total hits) for an offset and a number of results.
+        :param chunk_size: the number of results fetched at once.
+        :param max_results: the most results that can be paged through, however many pages match.
         """
+        self._fetch = fetch
+        self.chunk_size = chunk_size
+        self.max_results = max_results
+        # The number of pages matching the query, which may be more than can be paged through
+        self.total_hits = 0
+        # Results that have not been fetched yet are None
+        self._results: List[Optional[SearchResult]] = []
+        self._fetched_first = False
+        self._lock = asyncio.Lock()
 
-        self._check_query(query, "Query must be specified")
+    def prefill(self, results: List[SearchResult], total_hits: int) -> None:
+        """Fill in the first chunk of results, such as from a cache, without fetching it.
 
-        max_pull = 500
+        :param results: the first results.
+        :param total_hits: the number of pages matching the query."""
+        self.total_hits = total_hits
+        self._results = list(results) + [None] * (min(total_hits, self.max_results) - len(results))
+        self._fetched_first = True
 
-        search_params = {
-            "list": "search",
-            "srnamespace": "|".join(map(str, srnamespace)) if srnamespace else "*",
-            "srprop": "|".join(srprop) if srprop else "",
-            "srlimit": min(limit, max_pull) if limit is not None else max_pull,
-            "srsearch": query,
-            "sroffset": 0,  # this is what will be used to pull more than the max
-        }
-    
-        raw_results = self.wiki_request(search_params)
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def loaded(self, start: int, end: int) -> List[SearchResult]:
+        """Get the results in a range which have already been fetched.
+
+        :param start: the index of the first result.
+        :param end: the index after the last result.
+        :returns: the fetched results in the range."""
+        return [result for result in self._results[start:end] if result is not None]
 
-        self._check_error_response(raw_results, query)
+    async def load(self, start: int, end: int) -> List[SearchResult]:
+        """Get the results in a range, fetching any that are missing.
 
-        search_results = [SearchResult.model_validate(d) for d in raw_results["query"]["search"]]
+        :param start: the index of the first result.
+        :param end: the index after the last result.
+        :returns: the results in the range."""
+        async with self._lock:
+            if not self._fetched_first:
+                await self._fetch_chunk(0)
+            end = min(end, len(self._results))
+            # Fetch whole chunks, so paging back and forth reuses what has been fetched
+            for offset in range(start - start % self.chunk_size, end, self.chunk_size):
+                if None in self._results[offset:offset + self.chunk_size]:
+                    await self._fetch_chunk(offset)
+        return self.loaded(start, end)
 
-        return search_results
+    async def _fetch_chunk(self, offset: int) -> None:
+        """Fetch the chunk of results starting at an offset."""
+        count = self.chunk_size if not self._fetched_first else min(self.chunk_size, len(self._results) - offset)
+        results, total_hits = await self._fetch(offset, count)
+        if not self._fetched_first:
+            self.prefill(results[:self.max_results], total_hits)
+            return
+        results = results[:count]
+        self._results[offset:offset + len(results)] = results
+        if len(results) < count:
+            # The wiki has fewer results than it did before, so stop paging where they run out
+            del self._results[offset + len(results):]